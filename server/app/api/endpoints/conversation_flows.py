@@ -52,7 +52,7 @@ async def create_flow(flow_data: FlowCreate):
             flow_name=flow_data.name,
             flow_data=flow_data.flow
         )
-        return {"message": "Flow created successfully", "file_path": file_path}
+        return {"message": "Flow created successfully", "file_path": str(file_path)}
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -71,7 +71,7 @@ async def update_flow(flow_name: str, flow_data: FlowUpdate):
             flow_name=flow_name,
             flow_data=flow_data.flow
         )
-        return {"message": "Flow updated successfully", "file_path": file_path}
+        return {"message": "Flow updated successfully", "file_path": str(file_path)}
     except FileNotFoundError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -27,7 +27,7 @@ async def make_call(
 ):
     """Realizar llamada saliente con mensaje"""
     try:
-        result = call_service.make_call(to_number, message)
+        result = await call_service.make_call(to_number, message)
         return {
             "success": True,
             "data": result
@@ -49,7 +49,7 @@ async def handle_incoming_call(request: Request):
         
         # Crear respuesta TwiML
         message = "¡Hola! Gracias por llamar. Este es un mensaje automatizado."
-        twiml = call_service.create_simple_twiml(message)
+        twiml = await call_service.create_simple_twiml(message)
         
         return Response(content=twiml, media_type="application/xml")
         
@@ -76,7 +76,7 @@ async def handle_speech_input(
         logger.info(f"Procesando voz de {CallSid}: {SpeechResult}")
         
         # Procesar entrada de voz y generar respuesta
-        twiml = call_service.process_speech_input(CallSid, SpeechResult)
+        twiml = await call_service.process_speech_input(CallSid, SpeechResult)
         
         return Response(content=twiml, media_type="application/xml")
         
@@ -97,7 +97,7 @@ async def start_conversation_call(
         if not welcome_message:
             welcome_message = "¡Hola! Soy tu asistente virtual. ¿En qué puedo ayudarte hoy?"
         
-        result = call_service.start_conversation_call(to_number, welcome_message)
+        result = await call_service.start_conversation_call(to_number, welcome_message)
         return {
             "success": True,
             "data": result
@@ -110,7 +110,7 @@ async def start_conversation_call(
 async def get_conversation_history(call_sid: str):
     """Obtener historial de conversación"""
     try:
-        history = call_service.get_conversation_history(call_sid)
+        history = await call_service.get_conversation_history(call_sid)
         return {
             "success": True,
             "call_sid": call_sid,
@@ -124,7 +124,7 @@ async def get_conversation_history(call_sid: str):
 async def end_conversation(call_sid: str):
     """Finalizar conversación"""
     try:
-        success = call_service.end_conversation(call_sid)
+        success = await call_service.end_conversation(call_sid)
         return {
             "success": success,
             "message": "Conversación finalizada" if success else "Conversación no encontrada"
@@ -236,7 +236,7 @@ async def transcribe_audio_web(audio: UploadFile = File(...)):
 async def kanitts_status():
     """Verificar estado del servicio KaniTTS"""
     try:
-        available = call_service.kanitts_service.is_available()
+        available = await call_service.kanitts_service.is_available()
         return {
             "available": available,
             "status": "online" if available else "offline"
@@ -339,7 +339,7 @@ async def health_check():
     """Verificar estado del servicio de llamadas"""
     try:
         # Verificar servicios dependientes
-        kanitts_available = call_service.kanitts_service.is_available()
+        kanitts_available = await call_service.kanitts_service.is_available()
         twilio_configured = call_service.twilio_client is not None
         
         return {
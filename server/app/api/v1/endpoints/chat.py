@@ -2,14 +2,16 @@
 Chat API endpoints
 """
 
-from typing import List
+from typing import List, Optional
 from fastapi import APIRouter, HTTPException, Query, Depends
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import orjson
 from sqlalchemy.orm import Session
 
 from ....core.database import get_db
 from ....core.logging import get_logger
 from ....core.exceptions import ChatHistoryError, ValidationError
-from ....services.chat_service import ChatService
+from ....services.chat_service import ChatService, invalidate_active_sessions
 from ....repositories.user_repository import UserRepository
 from ....repositories.chat_repository import ChatRepository, MessageRepository
 from ....schemas.chat import (
@@ -60,7 +62,9 @@ async def send_message(request: SendMessageRequest):
 async def get_chat_history(
     phone_number: str = Query(..., description="User phone number"),
     limit: int = Query(50, ge=1, le=100, description="Number of messages"),
-    offset: int = Query(0, ge=0, description="Offset for pagination")
+    offset: int = Query(0, ge=0, description="Offset for pagination"),
+    before: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    include_total: bool = Query(False, description="Also return the user's total message count")
 ):
     """
     Get chat history for a specific user
@@ -71,7 +75,9 @@ async def get_chat_history(
         result = chat_service.get_chat_history(
             phone_number=phone_number,
             limit=limit,
-            offset=offset
+            offset=offset,
+            before_cursor=before,
+            include_total=include_total
         )
         
         # DEBUG: Log media fields for first message
@@ -94,7 +100,27 @@ async def get_chat_history(
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
-@router.get("/active-sessions", response_model=ActiveSessionsResponse)
+@router.get("/history/export")
+async def export_chat_history(
+    phone_number: str = Query(..., description="User phone number")
+):
+    """
+    Export a user's whole chat history as NDJSON (one message per line), streamed
+    """
+    try:
+        messages = chat_service.stream_chat_history(phone_number)
+    except ValidationError as e:
+        logger.warning(f"Validation error: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    def ndjson_generator():
+        for message in messages:
+            yield orjson.dumps(message) + b"\n"
+    
+    return StreamingResponse(ndjson_generator(), media_type="application/x-ndjson")
+
+
+@router.get("/active-sessions", response_model=ActiveSessionsResponse, response_class=ORJSONResponse)
 async def get_active_sessions(
     limit: int = Query(20, ge=1, le=100, description="Number of sessions")
 ):
@@ -303,33 +329,18 @@ async def send_bulk_template(
         if not phone_column:
              raise HTTPException(status_code=400, detail=f"Could not find phone number column. Headers found: {headers}")
              
-        successful = []
-        failed = []
-        errors = []
+        phone_numbers = [row[phone_column] for row in csv_reader if row.get(phone_column)]
         
-        for row in csv_reader:
-            phone_number = row.get(phone_column)
-            if not phone_number:
-                continue
-                
-            try:
-                # Clean phone number logic if needed, but service handles validation
-                result = chat_service.send_template_message(
-                    phone_number=phone_number,
-                    template_name=template_name,
-                    language_code="es" # Default to Spanish
-                )
-                successful.append(phone_number)
-                logger.info(f"Template sent successfully to {phone_number}")
-                
-            except Exception as e:
-                error_msg = str(e)
-                failed.append({
-                    "phone_number": phone_number,
-                    "error": error_msg
-                })
-                errors.append(f"{phone_number}: {error_msg}")
-                logger.error(f"Failed to send template to {phone_number}: {error_msg}")
+        # Sends go out per recipient; users, sessions and messages are stored in one batch
+        result = chat_service.send_template_messages_bulk(
+            phone_numbers=phone_numbers,
+            template_name=template_name,
+            language_code="es" # Default to Spanish
+        )
+        successful = result["successful"]
+        failed = result["failed"]
+        errors = result["errors"]
+        logger.info(f"Template sent to {len(successful)} of {len(phone_numbers)} recipients")
         
         return BulkMessageResponse(
             total_sent=len(successful),
@@ -358,6 +369,7 @@ async def end_chat_session(session_id: int, db: Session = Depends(get_db)):
             raise HTTPException(status_code=404, detail="Session not found")
         
         chat_repo.end_session(session_id)
+        invalidate_active_sessions()
         
         return {"status": "success", "message": f"Session {session_id} ended"}
         
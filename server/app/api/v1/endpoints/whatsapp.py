@@ -2,7 +2,8 @@
 WhatsApp API endpoints
 """
 
-from typing import Dict, Any
+import asyncio
+from typing import Dict, Any, List, Optional
 from fastapi import APIRouter, HTTPException, Request, Query, Depends, BackgroundTasks
 from fastapi.responses import PlainTextResponse
 
@@ -25,6 +26,13 @@ router = APIRouter()
 chat_service = ChatService()
 whatsapp_service = WhatsAppService()
 
+# Bounded queue between the webhook and the message workers: the webhook only
+# enqueues, so its latency no longer depends on Ollama
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 4
+_message_queue: Optional[asyncio.Queue] = None
+_message_workers: List[asyncio.Task] = []
+
 
 @router.get("/webhook", response_class=PlainTextResponse)
 async def verify_webhook(
@@ -95,7 +103,7 @@ async def receive_webhook(
                         
                         # Process ALL message types (text, image, document, audio, video, etc.)
                         # The ChatService will handle each type appropriately
-                        background_tasks.add_task(_process_webhook_message, webhook_data)
+                        _enqueue_webhook_message(webhook_data, background_tasks)
                         
                         return MessageProcessingResponse(
                             status="received",
@@ -146,7 +154,7 @@ async def receive_webhook(
                 }
                 
                 # Process converted message in background
-                background_tasks.add_task(_process_webhook_message, converted_data)
+                _enqueue_webhook_message(converted_data, background_tasks)
                 
                 return MessageProcessingResponse(
                     status="received",
@@ -171,6 +179,8 @@ async def receive_webhook(
             note="Webhook received - no messages to process"
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error in webhook: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -181,11 +191,57 @@ async def _process_webhook_message(webhook_data: Dict[str, Any]):
     Background task to process webhook message
     """
     try:
-        result = chat_service.process_incoming_message(webhook_data)
+        result = await chat_service.process_incoming_message_async(webhook_data)
     except Exception as e:
         logger.error(f"Background message processing error: {str(e)}")
 
 
+def _enqueue_webhook_message(webhook_data: Dict[str, Any], background_tasks: BackgroundTasks) -> None:
+    """
+    Hand a webhook message to the worker queue
+    
+    Falls back to a background task if the workers are not running. A full
+    queue answers 503 so WhatsApp retries the delivery later.
+    """
+    if _message_queue is None:
+        background_tasks.add_task(_process_webhook_message, webhook_data)
+        return
+    try:
+        _message_queue.put_nowait(webhook_data)
+    except asyncio.QueueFull:
+        logger.warning("Webhook queue full, asking WhatsApp to retry later")
+        raise HTTPException(status_code=503, detail="Message queue full")
+
+
+async def _message_worker():
+    """Consume queued webhook messages until cancelled"""
+    while True:
+        webhook_data = await _message_queue.get()
+        try:
+            await _process_webhook_message(webhook_data)
+        finally:
+            _message_queue.task_done()
+
+
+async def start_message_workers():
+    """Create the webhook queue and start its workers (called on app startup)"""
+    global _message_queue
+    _message_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    for _ in range(WEBHOOK_WORKERS):
+        _message_workers.append(asyncio.create_task(_message_worker()))
+    logger.info(f"Started {WEBHOOK_WORKERS} WhatsApp message workers")
+
+
+async def stop_message_workers():
+    """Cancel the webhook workers (called on app shutdown)"""
+    global _message_queue
+    for task in _message_workers:
+        task.cancel()
+    await asyncio.gather(*_message_workers, return_exceptions=True)
+    _message_workers.clear()
+    _message_queue = None
+
+
 @router.post("/send-message", response_model=SendMessageResponse)
 async def send_message(request: SendMessageRequest):
     """
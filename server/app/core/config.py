@@ -20,6 +20,9 @@ class Settings(BaseSettings):
     
     # Database Settings
     database_url: str = Field(default="sqlite:///./whatsapp_ai.db", env="DATABASE_URL")
+    database_read_url: Optional[str] = Field(default=None, env="DATABASE_READ_URL")
+    db_pool_size: int = Field(default=5, env="DB_POOL_SIZE")
+    db_max_overflow: int = Field(default=10, env="DB_MAX_OVERFLOW")
     
     # WhatsApp Business API Settings
     whatsapp_access_token: str = Field(..., env="WHATSAPP_ACCESS_TOKEN")
@@ -52,6 +55,9 @@ class Settings(BaseSettings):
     # Chat Settings
     max_conversation_history: int = Field(default=50, env="MAX_CONVERSATION_HISTORY")
     chat_session_timeout: int = Field(default=3600, env="CHAT_SESSION_TIMEOUT")  # 1 hour
+    semantic_cache_enabled: bool = Field(default=False, env="SEMANTIC_CACHE_ENABLED")
+    semantic_cache_threshold: float = Field(default=0.92, env="SEMANTIC_CACHE_THRESHOLD")
+    semantic_cache_max_entries: int = Field(default=10000, env="SEMANTIC_CACHE_MAX_ENTRIES")
 
     # Email / Resend Settings
     email_service_url: str = Field(default="http://localhost:4000", env="EMAIL_SERVICE_URL")
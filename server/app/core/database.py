@@ -13,34 +13,52 @@ from .config import get_settings
 
 settings = get_settings()
 
-# Create database engine
-if settings.database_url.startswith("sqlite"):
-    # SQLite configuration
-    engine = create_engine(
-        settings.database_url,
-        connect_args={
-            "check_same_thread": False,
-            "timeout": 30,
-            "isolation_level": None,
-            "detect_types": 1  # Enable type detection
-        },
-        poolclass=StaticPool,
-        echo=False  # Modified to reduce log noise
-    )
-else:
-    # PostgreSQL or other database configuration
-    engine = create_engine(
-        settings.database_url,
+# Compiled SQL cache entries per engine. SQLAlchemy 2.0 caches the compiled form
+# of every statement shape (the successor of baked queries); sized so the hot
+# repository lookups are never evicted by the long tail of admin queries.
+QUERY_CACHE_SIZE = 1200
+
+def _create_engine(database_url: str):
+    """Create an engine for the given URL"""
+    if database_url.startswith("sqlite"):
+        # SQLite configuration
+        return create_engine(
+            database_url,
+            connect_args={
+                "check_same_thread": False,
+                "timeout": 30,
+                "isolation_level": None,
+                "detect_types": 1  # Enable type detection
+            },
+            poolclass=StaticPool,
+            query_cache_size=QUERY_CACHE_SIZE,
+            echo=False  # Modified to reduce log noise
+        )
+    # PostgreSQL or other database configuration (QueuePool)
+    return create_engine(
+        database_url,
         echo=False,  # Modified to reduce log noise
         pool_pre_ping=True,
-        pool_recycle=3600,
-        pool_size=5,
-        max_overflow=10,
+        pool_recycle=1800,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        query_cache_size=QUERY_CACHE_SIZE,
         future=True
     )
 
+
+# Create database engine
+engine = _create_engine(settings.database_url)
+
+# Optional read replica for read-only dashboard queries; falls back to the primary
+read_engine = _create_engine(settings.database_read_url) if settings.database_read_url else engine
+
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = (
+    sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+    if read_engine is not engine else SessionLocal
+)
 
 # Create base class for models
 Base = declarative_base()
@@ -67,6 +85,11 @@ def create_tables():
         Base.metadata.create_all(bind=engine)
         print("✅ Tablas creadas exitosamente")
         
+        # create_all skips existing tables, so add indexes declared after they were created
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+        
         # Verify tables were created
         from sqlalchemy import inspect
         inspector = inspect(engine)
@@ -106,6 +129,33 @@ def get_db_context() -> Generator[Session, None, None]:
         db.close()
 
 
+class DbSession:
+    """
+    Class-based context manager for database session
+
+    Same contract as get_db_context() without the generator machinery of
+    @contextmanager; used on the message-processing hot path. readonly=True
+    uses the read replica when DATABASE_READ_URL is configured.
+    """
+
+    __slots__ = ("db", "readonly")
+
+    def __init__(self, readonly: bool = False):
+        self.readonly = readonly
+
+    def __enter__(self) -> Session:
+        self.db = ReadSessionLocal() if self.readonly else SessionLocal()
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        try:
+            if exc_type is not None:
+                self.db.rollback()
+        finally:
+            self.db.close()
+        return False
+
+
 def init_db():
     """Initialize database"""
     # Create data directory if it doesn't exist
@@ -119,4 +169,6 @@ def init_db():
 
 def close_db():
     """Close database connections"""
-    engine.dispose()
\ No newline at end of file
+    engine.dispose()
+    if read_engine is not engine:
+        read_engine.dispose()
\ No newline at end of file
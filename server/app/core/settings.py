@@ -31,6 +31,9 @@ class Settings(BaseSettings):
     twilio_auth_token: Optional[str] = None
     twilio_phone_number: Optional[str] = None
     
+    # Redis (estado compartido entre workers)
+    redis_url: Optional[str] = None
+    
     # Ollama
     ollama_base_url: str = "http://localhost:11434"
     ollama_model: str = "llama3"
@@ -172,6 +172,10 @@ async def unexpected_exception_handler(request: Request, exc: Exception):
     )
 
 
+# Background scheduler for periodic TTS file cleanup (set on startup)
+tts_cleanup_scheduler = None
+
+
 # Startup event
 @app.on_event("startup")
 async def startup_event():
@@ -196,6 +200,38 @@ async def startup_event():
         except Exception as e:
             logger.warning(f"Could not start SIP server: {str(e)} - continuing without it")
         
+        # Start WhatsApp webhook message workers
+        from .api.v1.endpoints.whatsapp import start_message_workers
+        await start_message_workers()
+        
+        # Sweep old TTS audio files hourly, off the request path
+        try:
+            from apscheduler.schedulers.background import BackgroundScheduler
+            from .api.v1.endpoints.calls import call_service
+            from .services.coqui_service import cleanup_cached_audio
+            global tts_cleanup_scheduler
+            tts_cleanup_scheduler = BackgroundScheduler(daemon=True)
+            tts_cleanup_scheduler.add_job(
+                call_service.kanitts_service.cleanup_old_files,
+                "interval",
+                hours=1,
+                id="tts_cleanup",
+                coalesce=True,
+                max_instances=1
+            )
+            tts_cleanup_scheduler.add_job(
+                cleanup_cached_audio,
+                "interval",
+                hours=1,
+                id="coqui_tts_cleanup",
+                coalesce=True,
+                max_instances=1
+            )
+            tts_cleanup_scheduler.start()
+            logger.info("TTS cleanup job scheduled")
+        except Exception as e:
+            logger.warning(f"Could not schedule TTS cleanup: {str(e)} - continuing without it")
+        
         # Check Ollama service health (non-blocking)
         # Temporarily disabled to allow backend to start
         # try:
@@ -232,6 +268,24 @@ async def shutdown_event():
         except Exception as e:
             logger.warning(f"Error stopping SIP server: {str(e)}")
         
+        # Stop WhatsApp webhook message workers
+        try:
+            from .api.v1.endpoints.whatsapp import stop_message_workers
+            await stop_message_workers()
+        except Exception as e:
+            logger.warning(f"Error stopping message workers: {str(e)}")
+        
+        # Stop the TTS cleanup job
+        if tts_cleanup_scheduler is not None:
+            tts_cleanup_scheduler.shutdown(wait=False)
+        
+        # Close shared TTS HTTP connections
+        try:
+            from .api.v1.endpoints.calls import call_service
+            await call_service.close()
+        except Exception as e:
+            logger.warning(f"Error closing call service: {str(e)}")
+        
         # Close database connections
         close_db()
         logger.info("Database connections closed")
@@ -4,7 +4,7 @@ Chat models for conversation management
 
 from datetime import datetime, date, time
 from enum import Enum
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, Enum as SQLEnum, Date, Time
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, Enum as SQLEnum, Date, Time, Index
 from sqlalchemy.orm import relationship
 
 from ..core.database import Base
@@ -42,6 +42,10 @@ class ChatSession(Base):
     """Chat session model for managing conversations"""
     
     __tablename__ = "chat_sessions"
+    __table_args__ = (
+        # Active-sessions dashboard: filter by status, newest activity first
+        Index("ix_chat_sessions_status_last_activity", "status", "last_activity_at"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -111,6 +115,12 @@ class Message(Base):
     """Message model for individual messages"""
     
     __tablename__ = "messages"
+    __table_args__ = (
+        # Per-session history reads and message counts
+        Index("ix_messages_session_timestamp", "chat_session_id", "timestamp"),
+        # Keyset pagination of a user's history: (timestamp, id) seek per page
+        Index("ix_messages_user_timestamp_id", "user_id", "timestamp", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -2,6 +2,7 @@
 Agent repository for database operations
 """
 
+from functools import lru_cache
 from typing import List, Optional, Dict, Any
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
@@ -9,6 +10,7 @@ from sqlalchemy import and_, or_
 
 from .base import BaseRepository
 from ..models.agent import Agent
+from ..core.database import DbSession
 from ..core.exceptions import DatabaseError
 
 
@@ -91,6 +93,25 @@ class AgentRepository(BaseRepository[Agent]):
         except SQLAlchemyError as e:
             raise DatabaseError(f"Error getting agent by Ollama model name {model_name}: {str(e)}")
     
+    def get_config_by_ollama_model_name(self, model_name: str) -> Optional[Dict[str, Any]]:
+        """Get the prompt-facing columns of the agent for an Ollama model, without the full row"""
+        try:
+            row = (
+                self.db.query(
+                    Agent.id,
+                    Agent.name,
+                    Agent.description,
+                    Agent.conversation_style,
+                    Agent.workflow_steps,
+                    Agent.conversation_structure
+                )
+                .filter(Agent.ollama_model_name == model_name)
+                .first()
+            )
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Error getting agent config for Ollama model name {model_name}: {str(e)}")
+        return dict(row._mapping) if row else None
+    
     def search_agents(self, query: str, user_id: Optional[int] = None) -> List[Agent]:
         """Search agents by name or description"""
         try:
@@ -207,4 +228,15 @@ class AgentRepository(BaseRepository[Agent]):
             return agent
         except SQLAlchemyError as e:
             self.db.rollback()
-            raise DatabaseError(f"Error activating agent {agent_id}: {str(e)}")
\ No newline at end of file
+            raise DatabaseError(f"Error activating agent {agent_id}: {str(e)}")
+
+
+@lru_cache(maxsize=16)
+def get_agent_config_cached(model_name: str) -> Optional[Dict[str, Any]]:
+    """
+    Agent configuration for an Ollama model, cached per process
+    
+    AgentService clears the cache whenever agents are created, updated or deleted.
+    """
+    with DbSession() as db:
+        return AgentRepository(db).get_config_by_ollama_model_name(model_name)
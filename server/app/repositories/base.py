@@ -21,8 +21,11 @@ class BaseRepository(Generic[ModelType]):
     
     def create(self, obj_data: Dict[str, Any]) -> ModelType:
         """Create a new record"""
+        return self.save(self.model(**obj_data))
+    
+    def save(self, db_obj: ModelType) -> ModelType:
+        """Add an unsaved record (and anything attached to it), commit and refresh it"""
         try:
-            db_obj = self.model(**obj_data)
             self.db.add(db_obj)
             self.db.commit()
             self.db.refresh(db_obj)
@@ -31,6 +34,16 @@ class BaseRepository(Generic[ModelType]):
             self.db.rollback()
             raise DatabaseError(f"Error creating {self.model.__name__}: {str(e)}")
     
+    def insert_many(self, rows: List[Dict[str, Any]]) -> None:
+        """Insert several records with one executemany INSERT; the caller commits"""
+        if not rows:
+            return
+        try:
+            self.db.execute(self.model.__table__.insert(), rows)
+        except SQLAlchemyError as e:
+            self.db.rollback()
+            raise DatabaseError(f"Error creating {self.model.__name__} records: {str(e)}")
+    
     def get(self, id: int) -> Optional[ModelType]:
         """Get a record by ID"""
         try:
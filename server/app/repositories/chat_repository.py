@@ -2,9 +2,10 @@
 Chat repository for chat and message-specific database operations
 """
 
-from typing import Optional, List, Dict, Any
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import desc, and_, func
+from typing import Optional, List, Dict, Any, Tuple, Iterator
+from sqlalchemy.orm import Session, joinedload, contains_eager, raiseload
+from sqlalchemy import desc, and_, func, select, lambda_stmt, tuple_, exists, Row
+from sqlalchemy.exc import SQLAlchemyError
 from datetime import datetime, timedelta
 
 from .base import BaseRepository
@@ -13,6 +14,19 @@ from ..models.user import User
 from ..core.exceptions import DatabaseError
 
 
+# Correlated message count selected next to each session in the dashboard query
+_SESSION_MESSAGE_COUNT = select(func.count(Message.id)).where(
+    Message.chat_session_id == ChatSession.id
+).correlate(ChatSession).scalar_subquery().label("message_count")
+
+
+# Columns of a message in chat history responses
+_HISTORY_COLUMNS = (
+    Message.id, Message.direction, Message.content, Message.message_type,
+    Message.created_at, Message.timestamp, Message.is_read, Message.is_delivered
+)
+
+
 class ChatRepository(BaseRepository[ChatSession]):
     """Repository for ChatSession model operations"""
     
@@ -27,15 +41,25 @@ class ChatRepository(BaseRepository[ChatSession]):
         channel: str = "whatsapp"
     ) -> ChatSession:
         """Create a new chat session"""
-        session_data = {
-            "user_id": user_id,
-            "session_id": session_id,
-            "channel": channel,
-            "ai_personality": ai_personality,
-            "started_at": datetime.utcnow(),
-            "last_activity_at": datetime.utcnow()
-        }
-        return self.create(session_data)
+        return self.save(self.build_session(user_id, session_id, ai_personality, channel))
+    
+    def build_session(
+        self,
+        user_id: int,
+        session_id: str,
+        ai_personality: str = "ema",
+        channel: str = "whatsapp"
+    ) -> ChatSession:
+        """Build an unsaved chat session; the caller adds and commits it"""
+        now = datetime.utcnow()
+        return ChatSession(
+            user_id=user_id,
+            session_id=session_id,
+            channel=channel,
+            ai_personality=ai_personality,
+            started_at=now,
+            last_activity_at=now
+        )
     
     def get_by_session_id(self, session_id: str) -> Optional[ChatSession]:
         """Get chat session by session ID"""
@@ -62,6 +86,94 @@ class ChatRepository(BaseRepository[ChatSession]):
         except Exception as e:
             raise DatabaseError(f"Error getting active session for user {user_id}: {str(e)}")
     
+    def get_active_sessions_for_users(self, user_ids: List[int]) -> Dict[int, ChatSession]:
+        """Get the most recent active session of each user with one IN query, keyed by user ID"""
+        if not user_ids:
+            return {}
+        try:
+            sessions = self.db.query(ChatSession).filter(
+                and_(
+                    ChatSession.user_id.in_(user_ids),
+                    ChatSession.status == ChatSessionStatus.ACTIVE
+                )
+            ).order_by(ChatSession.last_activity_at).all()
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Error getting active sessions for users: {str(e)}")
+        # Ascending order, so the newest session of each user wins
+        return {session.user_id: session for session in sessions}
+    
+    def _get_active_session_with_user(self, user_filter) -> Optional[ChatSession]:
+        """Get the most recent active session and its user in one joined query"""
+        return self.db.query(ChatSession).join(ChatSession.user).options(
+            contains_eager(ChatSession.user)
+        ).filter(
+            and_(
+                user_filter,
+                ChatSession.status == ChatSessionStatus.ACTIVE
+            )
+        ).order_by(desc(ChatSession.last_activity_at)).first()
+    
+    def get_active_session_for_whatsapp_id(self, whatsapp_id: str) -> Optional[ChatSession]:
+        """Get active chat session (with its user loaded) by the user's WhatsApp ID in one query"""
+        try:
+            return self._get_active_session_with_user(User.whatsapp_id == whatsapp_id)
+        except Exception as e:
+            raise DatabaseError(f"Error getting active session for WhatsApp ID {whatsapp_id}: {str(e)}")
+    
+    def get_active_session_for_phone_number(self, phone_number: str) -> Optional[ChatSession]:
+        """Get active chat session (with its user loaded) by the user's phone number in one query"""
+        try:
+            return self._get_active_session_with_user(User.phone_number == phone_number)
+        except Exception as e:
+            raise DatabaseError(f"Error getting active session for phone {phone_number}: {str(e)}")
+    
+    def bootstrap_email_conversation(
+        self,
+        email: str,
+        external_id: Optional[str] = None
+    ) -> Tuple[Optional[User], Optional[ChatSession], bool]:
+        """
+        Load what an inbound email needs in at most two queries
+        
+        An EXISTS check on the provider message id comes first; then the user and
+        their most recent active email session are fetched in one outer join, with
+        relationship lazy loads disabled (raiseload).
+        
+        Returns:
+            (user or None, active email session or None, is_duplicate); when the
+            email is a duplicate nothing else is loaded
+        """
+        try:
+            if external_id and self.db.query(
+                exists().where(Message.external_id == external_id)
+            ).scalar():
+                return None, None, True
+            
+            # Callers only read columns; raiseload turns any relationship access into an error
+            row = self.db.query(User, ChatSession).options(raiseload("*")).outerjoin(
+                ChatSession,
+                and_(
+                    ChatSession.user_id == User.id,
+                    ChatSession.status == ChatSessionStatus.ACTIVE,
+                    ChatSession.channel == "email"
+                )
+            ).filter(User.email == email).order_by(desc(ChatSession.last_activity_at)).first()
+        except Exception as e:
+            raise DatabaseError(f"Error loading email conversation for {email}: {str(e)}")
+        
+        if row is None:
+            return None, None, False
+        return row[0], row[1], False
+    
+    def get_user_id(self, chat_session_id: int) -> Optional[int]:
+        """Get only the user_id of a chat session, without loading the entity"""
+        try:
+            return self.db.query(ChatSession.user_id).filter(
+                ChatSession.id == chat_session_id
+            ).scalar()
+        except Exception as e:
+            raise DatabaseError(f"Error getting user for session {chat_session_id}: {str(e)}")
+    
     def get_active_session(self, user_id: int) -> Optional[ChatSession]:
         """Alias for get_active_session_for_user"""
         return self.get_active_session_for_user(user_id)
@@ -100,6 +212,59 @@ class ChatRepository(BaseRepository[ChatSession]):
             return self.update(session.id, update_data)
         return None
     
+    def _sessions_with_messages_stmt(self, status: Optional[ChatSessionStatus], limit: int):
+        """Session + user columns and message count, most recently active first"""
+        # lambda_stmt caches the constructed statement itself, not just its SQL;
+        # status and limit are picked up as bound parameters
+        stmt = lambda_stmt(lambda: select(
+            ChatSession.id,
+            User.id,
+            User.phone_number,
+            User.name,
+            ChatSession.started_at,
+            ChatSession.last_activity_at,
+            _SESSION_MESSAGE_COUNT,
+            ChatSession.status
+        ).join(ChatSession.user))
+        if status:
+            stmt += lambda s: s.where(ChatSession.status == status)
+        stmt += lambda s: s.order_by(desc(ChatSession.last_activity_at)).limit(limit)
+        return stmt
+    
+    def get_sessions_with_messages(
+        self,
+        status: Optional[ChatSessionStatus] = None,
+        limit: int = 20
+    ) -> List[Row]:
+        """
+        Get most recently active sessions with their user in one query (no N+1)
+        
+        Only the dashboard columns are selected, so no entities are hydrated.
+        
+        Returns:
+            Rows of (session_id, user_id, phone_number, name, started_at,
+            last_activity_at, message_count, status)
+        """
+        try:
+            return self.db.execute(self._sessions_with_messages_stmt(status, limit)).all()
+        except Exception as e:
+            raise DatabaseError(f"Error getting sessions: {str(e)}")
+    
+    def iter_sessions_with_messages(
+        self,
+        status: Optional[ChatSessionStatus] = None,
+        limit: int = 20,
+        batch_size: int = 100
+    ) -> Iterator[Row]:
+        """Same rows as get_sessions_with_messages, fetched from the cursor batch_size at a time"""
+        try:
+            yield from self.db.execute(
+                self._sessions_with_messages_stmt(status, limit),
+                execution_options={"yield_per": batch_size}
+            )
+        except Exception as e:
+            raise DatabaseError(f"Error getting sessions: {str(e)}")
+    
     def get_session_with_messages(self, session_id: str) -> Optional[ChatSession]:
         """Get session with all its messages"""
         try:
@@ -134,6 +299,41 @@ class MessageRepository(BaseRepository[Message]):
         media_filename: Optional[str] = None
     ) -> Message:
         """Create a new message"""
+        return self.save(self.build_message(
+            user_id=user_id,
+            chat_session_id=chat_session_id,
+            content=content,
+            direction=direction,
+            message_type=message_type,
+            whatsapp_message_id=whatsapp_message_id,
+            raw_content=raw_content,
+            channel=channel,
+            external_id=external_id,
+            subject=subject,
+            media_url=media_url,
+            media_mime_type=media_mime_type,
+            media_local_path=media_local_path,
+            media_filename=media_filename
+        ))
+    
+    def build_message(
+        self,
+        user_id: int,
+        chat_session_id: Optional[int],
+        content: str,
+        direction: MessageDirection,
+        message_type: str = "text",
+        whatsapp_message_id: Optional[str] = None,
+        raw_content: Optional[str] = None,
+        channel: str = "whatsapp",
+        external_id: Optional[str] = None,
+        subject: Optional[str] = None,
+        media_url: Optional[str] = None,
+        media_mime_type: Optional[str] = None,
+        media_local_path: Optional[str] = None,
+        media_filename: Optional[str] = None
+    ) -> Message:
+        """Build an unsaved message; the caller adds and commits it"""
         message_data = {
             "user_id": user_id,
             "chat_session_id": chat_session_id,
@@ -151,7 +351,27 @@ class MessageRepository(BaseRepository[Message]):
             "media_local_path": media_local_path,
             "media_filename": media_filename
         }
-        return self.create(message_data)
+        return Message(**message_data)
+    
+    def create_messages(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        Insert several messages with a single executemany INSERT and one commit
+        
+        Args:
+            rows: Column values per message; timestamp defaults to now
+        """
+        if not rows:
+            return
+        now = datetime.utcnow()
+        try:
+            self.db.execute(
+                Message.__table__.insert(),
+                [{"timestamp": now, **row} for row in rows]
+            )
+            self.db.commit()
+        except SQLAlchemyError as e:
+            self.db.rollback()
+            raise DatabaseError(f"Error creating messages: {str(e)}")
     
     def get_by_whatsapp_id(self, whatsapp_message_id: str) -> Optional[Message]:
         """Get message by WhatsApp message ID"""
@@ -191,10 +411,33 @@ class MessageRepository(BaseRepository[Message]):
         try:
             return self.db.query(Message).filter(
                 Message.chat_session_id == session_id
-            ).order_by(Message.timestamp).offset(skip).limit(limit).all()
+            ).order_by(Message.timestamp, Message.id).offset(skip).limit(limit).all()
         except Exception as e:
             raise DatabaseError(f"Error getting messages for session {session_id}: {str(e)}")
     
+    def get_history_raw(
+        self,
+        session_id: int,
+        skip: int = 0,
+        limit: int = 100
+    ) -> List[Tuple[MessageDirection, str]]:
+        """Get (direction, content) rows for a chat session without loading Message entities"""
+        try:
+            return self.db.query(Message.direction, Message.content).filter(
+                Message.chat_session_id == session_id
+            ).order_by(Message.timestamp, Message.id).offset(skip).limit(limit).all()
+        except Exception as e:
+            raise DatabaseError(f"Error getting history for session {session_id}: {str(e)}")
+    
+    def count_session_messages(self, session_id: int) -> int:
+        """Count messages in a chat session"""
+        try:
+            return self.db.query(func.count(Message.id)).filter(
+                Message.chat_session_id == session_id
+            ).scalar() or 0
+        except Exception as e:
+            raise DatabaseError(f"Error counting messages for session {session_id}: {str(e)}")
+    
     def get_recent_messages(
         self,
         session_id: int,
@@ -204,7 +447,7 @@ class MessageRepository(BaseRepository[Message]):
         try:
             return self.db.query(Message).filter(
                 Message.chat_session_id == session_id
-            ).order_by(desc(Message.timestamp)).limit(limit).all()
+            ).order_by(desc(Message.timestamp), desc(Message.id)).limit(limit).all()
         except Exception as e:
             raise DatabaseError(f"Error getting recent messages: {str(e)}")
     
@@ -218,10 +461,65 @@ class MessageRepository(BaseRepository[Message]):
         try:
             return self.db.query(Message).filter(
                 Message.user_id == user_id
-            ).order_by(desc(Message.timestamp)).offset(offset).limit(limit).all()
+            ).order_by(desc(Message.timestamp), desc(Message.id)).offset(offset).limit(limit).all()
         except Exception as e:
             raise DatabaseError(f"Error getting messages for user {user_id}: {str(e)}")
 
+    def get_user_messages_projected(
+        self,
+        user_id: int,
+        limit: int = 100,
+        offset: int = 0,
+        before: Optional[Tuple[datetime, int]] = None,
+        with_total: bool = False
+    ) -> List[Row]:
+        """
+        Get a page of a user's messages (newest first) as column rows
+        
+        Only the history columns are selected, so no entities are hydrated.
+        
+        Args:
+            user_id: ID of the user
+            limit: Maximum number of messages to return
+            offset: Rows to skip (ignored when `before` is given)
+            before: (timestamp, id) of the oldest row of the previous page; seeks the
+                (user_id, timestamp, id) index instead of skipping OFFSET rows
+            with_total: Add a `total` column with the user's message count (COUNT(*) OVER ())
+            
+        Returns:
+            Rows of (id, direction, content, message_type, created_at, timestamp,
+            is_read, is_delivered[, total])
+        """
+        columns = list(_HISTORY_COLUMNS)
+        if with_total:
+            columns.append(func.count(Message.id).over().label("total"))
+        
+        stmt = select(*columns).where(Message.user_id == user_id)
+        if before is not None:
+            stmt = stmt.where(tuple_(Message.timestamp, Message.id) < tuple_(*before))
+        elif offset:
+            stmt = stmt.offset(offset)
+        
+        try:
+            return self.db.execute(
+                stmt.order_by(desc(Message.timestamp), desc(Message.id)).limit(limit)
+            ).all()
+        except Exception as e:
+            raise DatabaseError(f"Error getting messages for user {user_id}: {str(e)}")
+    
+    def iter_user_messages_projected(self, user_id: int, batch_size: int = 200) -> Iterator[Row]:
+        """
+        All of a user's messages (oldest first) as history column rows,
+        fetched from the cursor batch_size at a time
+        """
+        stmt = select(*_HISTORY_COLUMNS).where(
+            Message.user_id == user_id
+        ).order_by(Message.timestamp, Message.id)
+        try:
+            yield from self.db.execute(stmt, execution_options={"yield_per": batch_size})
+        except Exception as e:
+            raise DatabaseError(f"Error getting messages for user {user_id}: {str(e)}")
+    
     def count_user_messages(self, user_id: int) -> int:
         """Count total messages for a user"""
         try:
@@ -264,22 +562,23 @@ class MessageRepository(BaseRepository[Message]):
     ) -> List[Dict[str, Any]]:
         """Get conversation context for AI processing"""
         try:
-            messages = self.db.query(Message).filter(
+            # Only the columns the prompt needs; the newest rows come from the
+            # (chat_session_id, timestamp) index and are walked back in reverse
+            # (batched rows share a timestamp, so id keeps their insertion order)
+            rows = self.db.query(
+                Message.direction, Message.content, Message.timestamp
+            ).filter(
                 Message.chat_session_id == session_id
-            ).order_by(desc(Message.timestamp)).limit(max_messages).all()
-            
-            # Reverse to get chronological order
-            messages.reverse()
-            
-            context = []
-            for msg in messages:
-                context.append({
-                    "role": "user" if msg.direction == MessageDirection.INCOMING else "assistant",
-                    "content": msg.content,
-                    "timestamp": msg.timestamp.isoformat()
-                })
+            ).order_by(desc(Message.timestamp), desc(Message.id)).limit(max_messages).all()
             
-            return context
+            return [
+                {
+                    "role": "user" if direction is MessageDirection.INCOMING else "assistant",
+                    "content": content,
+                    "timestamp": timestamp.isoformat()
+                }
+                for direction, content, timestamp in reversed(rows)
+            ]
         except Exception as e:
             raise DatabaseError(f"Error getting conversation context: {str(e)}")
     
@@ -2,9 +2,11 @@
 User repository for user-specific database operations
 """
 
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
 
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects import postgresql, sqlite
 from datetime import datetime
 
 from .base import BaseRepository
@@ -22,6 +24,48 @@ class UserRepository(BaseRepository[User]):
         """Get user by phone number"""
         return self.get_by_field("phone_number", phone_number)
     
+    def get_by_phone_numbers(self, phone_numbers: List[str]) -> Dict[str, User]:
+        """Get users for several phone numbers with one IN query, keyed by phone number"""
+        if not phone_numbers:
+            return {}
+        try:
+            users = self.db.query(User).filter(User.phone_number.in_(phone_numbers)).all()
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Error getting users by phone number: {str(e)}")
+        return {user.phone_number: user for user in users}
+    
+    def upsert_by_phone_numbers(self, rows: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Insert users whose phone number is new and return ids for all rows, keyed by phone number
+        
+        On PostgreSQL and SQLite this is one INSERT ... ON CONFLICT (phone_number)
+        ... RETURNING statement; existing users are left unchanged. Other backends
+        fall back to lookup, insert of the missing rows and re-read. The caller commits.
+        """
+        if not rows:
+            return {}
+        
+        dialect = self.db.get_bind().dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+            stmt = insert(User).values(rows)
+            # A no-op update (instead of DO NOTHING) so existing rows are returned too
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[User.phone_number],
+                set_={"phone_number": stmt.excluded.phone_number}
+            ).returning(User.phone_number, User.id)
+            try:
+                return {phone: user_id for phone, user_id in self.db.execute(stmt)}
+            except SQLAlchemyError as e:
+                self.db.rollback()
+                raise DatabaseError(f"Error upserting users: {str(e)}")
+        
+        phones = [row["phone_number"] for row in rows]
+        users = self.get_by_phone_numbers(phones)
+        self.insert_many([row for row in rows if row["phone_number"] not in users])
+        users.update(self.get_by_phone_numbers([phone for phone in phones if phone not in users]))
+        return {phone: user.id for phone, user in users.items()}
+    
     def get_by_whatsapp_id(self, whatsapp_id: str) -> Optional[User]:
         """Get user by WhatsApp ID"""
         return self.get_by_field("whatsapp_id", whatsapp_id)
@@ -50,9 +50,11 @@ class ChatHistoryResponse(BaseModel):
     """Schema for chat history response"""
     user: Optional[UserInfo]
     messages: List[MessageInfo]
-    total: int
+    total: Optional[int] = None  # Only counted when include_total is requested
     limit: int
     offset: int
+    has_more: bool = False
+    next_cursor: Optional[str] = None
 
 
 class ActiveSessionUser(BaseModel):
@@ -66,8 +68,8 @@ class ActiveSession(BaseModel):
     """Schema for active session"""
     session_id: int
     user: ActiveSessionUser
-    started_at: Optional[str] = None
-    last_message_at: Optional[str] = None
+    started_at: Optional[datetime] = None
+    last_message_at: Optional[datetime] = None
     message_count: int
     status: str
 
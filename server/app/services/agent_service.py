@@ -15,7 +15,7 @@ from ..core.config import get_settings
 from ..core.logging import get_logger
 from ..core.exceptions import AgentError, OllamaError, ServiceUnavailableError
 from ..models.agent import Agent
-from ..repositories.agent_repository import AgentRepository
+from ..repositories.agent_repository import AgentRepository, get_agent_config_cached
 from ..schemas.agent import AgentCreate, AgentUpdate, OllamaModelCreate
 from .ollama_service import OllamaService
 from .rag_service import rag_service
@@ -53,6 +53,7 @@ class AgentService:
             
             # Create agent in database
             agent = self.agent_repo.create(agent_dict)
+            get_agent_config_cached.cache_clear()
             
             logger.info(f"Agent created successfully: {agent.name} (ID: {agent.id})")
             return agent
@@ -116,6 +117,7 @@ class AgentService:
                 
                 # Create agent in database
                 agent = self.agent_repo.create(agent_data)
+                get_agent_config_cached.cache_clear()
                 
                 return {
                     "success": True,
@@ -290,6 +292,7 @@ class AgentService:
             update_dict['updated_at'] = datetime.utcnow()
             
             agent = self.agent_repo.update(agent_id, update_dict)
+            get_agent_config_cached.cache_clear()
             
             if agent:
                 logger.info(f"Agent updated successfully: {agent.name} (ID: {agent.id})")
@@ -321,6 +324,7 @@ class AgentService:
             
             # Delete agent from database
             success = self.agent_repo.delete(agent_id)
+            get_agent_config_cached.cache_clear()
             
             if success:
                 logger.info(f"Agent deleted successfully: {agent.name} (ID: {agent.id})")
@@ -483,6 +487,7 @@ class AgentService:
                 }
                 
                 updated_agent = self.agent_repo.update(agent_id, update_data)
+                get_agent_config_cached.cache_clear()
                 
                 if not updated_agent:
                     raise AgentError("Failed to update agent in database")
@@ -1,12 +1,18 @@
 """
 Servicio para manejo de llamadas telefónicas con Twilio
 """
+import asyncio
+import copy
 import logging
+import xml.etree.ElementTree as ET
+from collections import defaultdict, deque
 from typing import Dict, List, Optional
 from datetime import datetime
 import uuid
 
-from twilio.twiml.voice_response import VoiceResponse, Gather
+import httpx
+import orjson
+from twilio.twiml.voice_response import VoiceResponse
 from twilio.rest import Client
 from fastapi import HTTPException
 
@@ -14,15 +20,77 @@ from app.core.settings import get_settings
 from app.services.chat_service import ChatService
 from app.services.kanitts_service import KaniTTSService
 
+try:
+    from redis.asyncio import Redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+    Redis = None
+
 logger = logging.getLogger(__name__)
 
+# Turnos recientes que se envían al modelo; los más antiguos se resumen
+RECENT_TURNS_WINDOW = 8
+# Tiempo de vida del estado de una llamada en Redis (segundos)
+CONVERSATION_TTL = 3600
+
+_XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>'
+_SAY_ATTRS = {"language": "es-MX", "voice": "alice"}
+
+
+def _build_gather_template() -> ET.Element:
+    """Árbol TwiML base: <Gather> de voz, despedida y <Hangup>"""
+    root = ET.Element("Response")
+    gather = ET.SubElement(root, "Gather", {
+        "action": "/api/v1/calls/webhook/speech",
+        "input": "speech",
+        "language": "es-MX",
+        "method": "POST",
+        "speechTimeout": "auto"
+    })
+    ET.SubElement(gather, "Say", _SAY_ATTRS)
+    ET.SubElement(root, "Say", _SAY_ATTRS)
+    ET.SubElement(root, "Hangup")
+    return root
+
+
+# Se construye una vez y se copia por llamada (más barato que el builder de Twilio)
+_GATHER_TEMPLATE = _build_gather_template()
+
 class CallService:
+    __slots__ = (
+        'settings', 'twilio_client', 'chat_service', '_tts_http', 'kanitts_service',
+        'redis', 'conversations', '_summary_tasks', '_locks',
+        'make_call', 'start_conversation_call',
+    )
+
     def __init__(self):
         self.settings = get_settings()
         self.twilio_client = None
         self.chat_service = ChatService()
-        self.kanitts_service = KaniTTSService()
-        self.conversations: Dict[str, List[Dict]] = {}
+        # Pool de conexiones keep-alive compartido por todas las síntesis de voz;
+        # reintenta solo fallos de conexión (seguro también para POST)
+        self._tts_http = httpx.AsyncClient(
+            timeout=10.0,
+            transport=httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=64),
+                retries=2
+            )
+        )
+        self.kanitts_service = KaniTTSService(http_client=self._tts_http)
+        # Estado compartido entre workers si hay Redis; si no, en memoria del proceso
+        self.redis = None
+        if self.settings.redis_url:
+            if REDIS_AVAILABLE:
+                self.redis = Redis.from_url(self.settings.redis_url)
+            else:
+                logger.warning("REDIS_URL configurado pero el paquete redis no está instalado")
+        # Por call_sid: {"recent": deque(maxlen=RECENT_TURNS_WINDOW), "summary": str}
+        self.conversations: Dict[str, Dict] = {}
+        # Último resumen en curso por llamada, para aplicarlos en orden
+        self._summary_tasks: Dict[str, asyncio.Task] = {}
+        # Serializa los turnos de una misma llamada (reintentos de webhook de Twilio)
+        self._locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
         
         # Inicializar cliente Twilio si las credenciales están disponibles
         if (self.settings.twilio_account_sid and 
@@ -38,14 +106,22 @@ class CallService:
                 logger.error(f"Error inicializando cliente Twilio: {e}")
         else:
             logger.warning("Credenciales de Twilio no configuradas")
+        
+        # Resolver una sola vez qué implementación atiende las llamadas salientes
+        if self.twilio_client:
+            self.make_call = self._real_make_call
+            self.start_conversation_call = self._real_start_conversation_call
+        else:
+            self.make_call = self._disabled_make_call
+            self.start_conversation_call = self._disabled_start_conversation_call
 
-    def create_simple_twiml(self, message: str) -> str:
+    async def create_simple_twiml(self, message: str) -> str:
         """Crear respuesta TwiML simple con mensaje de voz"""
         try:
             response = VoiceResponse()
             
-            # Generar audio con KaniTTS
-            audio_url = self.kanitts_service.generate_speech(message)
+            # Generar audio con KaniTTS (si está deshabilitado, directo a <Say>)
+            audio_url = await self.kanitts_service.generate_speech(message) if self.kanitts_service.enabled else None
             
             if audio_url:
                 # Usar el audio generado
@@ -63,101 +139,181 @@ class CallService:
             response.say("Lo siento, hay un problema técnico.", language='es-MX')
             return str(response)
 
-    def create_conversation_twiml(self, welcome_message: str = None) -> str:
+    async def create_conversation_twiml(self, welcome_message: str = None) -> str:
         """Crear TwiML para iniciar una conversación interactiva"""
         try:
-            response = VoiceResponse()
-            
-            # Mensaje de bienvenida
-            if welcome_message:
-                audio_url = self.kanitts_service.generate_speech(welcome_message)
-                if audio_url:
-                    response.play(audio_url)
-                else:
-                    response.say(welcome_message, language='es-MX', voice='alice')
+            audio_url = None
+            if welcome_message and self.kanitts_service.enabled:
+                audio_url = await self.kanitts_service.generate_speech(welcome_message)
             
-            # Configurar captura de voz
-            gather = Gather(
-                input='speech',
-                action='/api/v1/calls/webhook/speech',
-                method='POST',
-                speech_timeout='auto',
-                language='es-MX'
+            return self._build_gather_xml(
+                message=welcome_message,
+                audio_url=audio_url,
+                prompt="Por favor, dime en qué puedo ayudarte.",
+                farewell="No escuché nada. Hasta luego."
             )
             
-            gather.say("Por favor, dime en qué puedo ayudarte.", language='es-MX', voice='alice')
-            response.append(gather)
-            
-            # Si no se detecta voz
-            response.say("No escuché nada. Hasta luego.", language='es-MX', voice='alice')
-            response.hangup()
-            
-            return str(response)
-            
         except Exception as e:
             logger.error(f"Error creando TwiML conversacional: {e}")
             response = VoiceResponse()
             response.say("Lo siento, hay un problema técnico.", language='es-MX')
             return str(response)
 
-    def process_speech_input(self, call_sid: str, speech_result: str) -> str:
+    def _build_gather_xml(
+        self,
+        message: Optional[str],
+        audio_url: Optional[str],
+        prompt: str,
+        farewell: str
+    ) -> str:
+        """
+        Construir TwiML de turno conversacional sin pasar por el builder de Twilio
+        
+        Args:
+            message: Texto a reproducir antes de escuchar (opcional)
+            audio_url: Audio TTS ya generado para el mensaje (opcional)
+            prompt: Texto dentro del <Gather>
+            farewell: Texto si el usuario no responde
+        """
+        root = copy.deepcopy(_GATHER_TEMPLATE)
+        gather, farewell_say, _ = root
+        gather[0].text = prompt
+        farewell_say.text = farewell
+        
+        if audio_url:
+            play = ET.Element("Play")
+            play.text = audio_url
+            root.insert(0, play)
+        elif message:
+            say = ET.Element("Say", _SAY_ATTRS)
+            say.text = message
+            root.insert(0, say)
+        
+        return _XML_DECLARATION + ET.tostring(root, encoding="unicode")
+
+    def _get_conversation(self, call_sid: str) -> Dict:
+        """Obtener (o crear) el estado en memoria de una llamada"""
+        conversation = self.conversations.get(call_sid)
+        if conversation is None:
+            conversation = {"recent": deque(maxlen=RECENT_TURNS_WINDOW), "summary": ""}
+            self.conversations[call_sid] = conversation
+        return conversation
+
+    async def _append_turn(self, call_sid: str, message: Dict) -> None:
+        """Agregar un turno a la ventana; el turno desalojado se resume en segundo plano"""
+        evicted = None
+        if self.redis:
+            key = f"conv:{call_sid}"
+            length = await self.redis.rpush(key, orjson.dumps(message))
+            if length > RECENT_TURNS_WINDOW:
+                raw = await self.redis.lpop(key)
+                evicted = orjson.loads(raw) if raw else None
+            await self.redis.expire(key, CONVERSATION_TTL)
+        else:
+            recent = self._get_conversation(call_sid)["recent"]
+            if len(recent) == recent.maxlen:
+                evicted = recent[0]
+            recent.append(message)
+        
+        if evicted:
+            previous = self._summary_tasks.get(call_sid)
+            self._summary_tasks[call_sid] = asyncio.create_task(
+                self._fold_into_summary(call_sid, evicted, previous)
+            )
+
+    async def _load_turns(self, call_sid: str) -> List[Dict]:
+        """Turnos recientes de la llamada"""
+        if self.redis:
+            return [orjson.loads(raw) for raw in await self.redis.lrange(f"conv:{call_sid}", 0, -1)]
+        conversation = self.conversations.get(call_sid)
+        return list(conversation["recent"]) if conversation else []
+
+    async def _get_summary(self, call_sid: str) -> str:
+        """Resumen acumulado de los turnos desalojados"""
+        if self.redis:
+            raw = await self.redis.get(f"conv:{call_sid}:summary")
+            return raw.decode() if raw else ""
+        conversation = self.conversations.get(call_sid)
+        return conversation["summary"] if conversation else ""
+
+    async def _fold_into_summary(
+        self,
+        call_sid: str,
+        evicted: Dict,
+        previous: Optional[asyncio.Task] = None
+    ) -> None:
+        """Incorporar un turno desalojado al resumen acumulado de la llamada"""
+        try:
+            if previous:
+                await asyncio.wait([previous])
+            lines = []
+            summary = await self._get_summary(call_sid)
+            if summary:
+                lines.append(summary)
+            lines.append(f"{evicted['role']}: {evicted['content']}")
+            summary = await asyncio.to_thread(self.chat_service.ollama_service.generate_summary, lines)
+            if not summary:
+                return
+            if self.redis:
+                # Una llamada ya finalizada no debe recuperar su resumen
+                if await self.redis.exists(f"conv:{call_sid}"):
+                    await self.redis.set(f"conv:{call_sid}:summary", summary, ex=CONVERSATION_TTL)
+            elif call_sid in self.conversations:
+                self.conversations[call_sid]["summary"] = summary
+        except Exception as e:
+            logger.error(f"Error resumiendo conversación {call_sid}: {e}")
+        finally:
+            if self._summary_tasks.get(call_sid) is asyncio.current_task():
+                del self._summary_tasks[call_sid]
+
+    async def _build_prompt_history(self, call_sid: str) -> List[Dict]:
+        """Historial acotado para el modelo: resumen + últimos turnos"""
+        history = await self._load_turns(call_sid)
+        summary = await self._get_summary(call_sid)
+        if summary:
+            history.insert(0, {"role": "system", "content": summary})
+        return history
+
+    async def process_speech_input(self, call_sid: str, speech_result: str) -> str:
         """Procesar entrada de voz del usuario y generar respuesta"""
         try:
-            # Inicializar conversación si no existe
-            if call_sid not in self.conversations:
-                self.conversations[call_sid] = []
-            
-            # Agregar mensaje del usuario
-            user_message = {
-                "role": "user",
-                "content": speech_result,
-                "timestamp": datetime.now().isoformat()
-            }
-            self.conversations[call_sid].append(user_message)
-            
-            # Generar respuesta con IA
-            ai_response = self.chat_service.generate_response(
-                message=speech_result,
-                conversation_history=self.conversations[call_sid]
-            )
-            
-            # Agregar respuesta de IA
-            ai_message = {
-                "role": "assistant", 
-                "content": ai_response,
-                "timestamp": datetime.now().isoformat()
-            }
-            self.conversations[call_sid].append(ai_message)
-            
-            # Crear TwiML con la respuesta
-            response = VoiceResponse()
-            
-            # Generar audio con KaniTTS
-            audio_url = self.kanitts_service.generate_speech(ai_response)
+            async with self._locks[call_sid]:
+                # Agregar mensaje del usuario
+                user_message = {
+                    "role": "user",
+                    "content": speech_result,
+                    "timestamp": datetime.now().isoformat()
+                }
+                await self._append_turn(call_sid, user_message)
+                
+                # Generar respuesta con IA (solo ventana reciente + resumen)
+                ai_response = await asyncio.to_thread(
+                    self.chat_service.generate_response,
+                    message=speech_result,
+                    conversation_history=await self._build_prompt_history(call_sid)
+                )
+                
+                # Agregar respuesta de IA
+                ai_message = {
+                    "role": "assistant", 
+                    "content": ai_response,
+                    "timestamp": datetime.now().isoformat()
+                }
+                await self._append_turn(call_sid, ai_message)
             
-            if audio_url:
-                response.play(audio_url)
-            else:
-                response.say(ai_response, language='es-MX', voice='alice')
+            # Generar audio con KaniTTS (si está deshabilitado, directo a <Say>)
+            audio_url = None
+            if self.kanitts_service.enabled:
+                audio_url = await self.kanitts_service.generate_speech(ai_response)
             
-            # Continuar la conversación
-            gather = Gather(
-                input='speech',
-                action='/api/v1/calls/webhook/speech',
-                method='POST',
-                speech_timeout='auto',
-                language='es-MX'
+            # Crear TwiML con la respuesta y continuar la conversación
+            return self._build_gather_xml(
+                message=ai_response,
+                audio_url=audio_url,
+                prompt="¿Hay algo más en lo que pueda ayudarte?",
+                farewell="Gracias por llamar. Hasta luego."
             )
             
-            gather.say("¿Hay algo más en lo que pueda ayudarte?", language='es-MX', voice='alice')
-            response.append(gather)
-            
-            # Si no hay más entrada
-            response.say("Gracias por llamar. Hasta luego.", language='es-MX', voice='alice')
-            response.hangup()
-            
-            return str(response)
-            
         except Exception as e:
             logger.error(f"Error procesando entrada de voz: {e}")
             response = VoiceResponse()
@@ -165,9 +321,18 @@ class CallService:
             response.hangup()
             return str(response)
 
-    def end_conversation(self, call_sid: str) -> bool:
+    async def end_conversation(self, call_sid: str) -> bool:
         """Finalizar conversación y limpiar datos"""
         try:
+            self._locks.pop(call_sid, None)
+            summary_task = self._summary_tasks.pop(call_sid, None)
+            if summary_task:
+                summary_task.cancel()
+            if self.redis:
+                deleted = await self.redis.delete(f"conv:{call_sid}", f"conv:{call_sid}:summary")
+                if deleted:
+                    logger.info(f"Conversación {call_sid} finalizada")
+                return bool(deleted)
             if call_sid in self.conversations:
                 del self.conversations[call_sid]
                 logger.info(f"Conversación {call_sid} finalizada")
@@ -177,21 +342,27 @@ class CallService:
             logger.error(f"Error finalizando conversación: {e}")
             return False
 
-    def get_conversation_history(self, call_sid: str) -> List[Dict]:
-        """Obtener historial de conversación"""
-        return self.conversations.get(call_sid, [])
+    async def get_conversation_history(self, call_sid: str) -> List[Dict]:
+        """Obtener historial de conversación (turnos recientes)"""
+        return await self._load_turns(call_sid)
+
+    async def close(self) -> None:
+        """Liberar conexiones HTTP compartidas"""
+        await self._tts_http.aclose()
+
+    async def _disabled_make_call(self, to_number: str, message: str) -> Dict:
+        """make_call cuando Twilio no está configurado"""
+        raise HTTPException(status_code=500, detail="Cliente Twilio no configurado")
 
-    def make_call(self, to_number: str, message: str) -> Dict:
+    async def _real_make_call(self, to_number: str, message: str) -> Dict:
         """Realizar llamada saliente"""
-        if not self.twilio_client:
-            raise HTTPException(status_code=500, detail="Cliente Twilio no configurado")
-        
         try:
             # Crear TwiML para la llamada
-            twiml = self.create_simple_twiml(message)
+            twiml = await self.create_simple_twiml(message)
             
             # Realizar llamada
-            call = self.twilio_client.calls.create(
+            call = await asyncio.to_thread(
+                self.twilio_client.calls.create,
                 twiml=twiml,
                 to=to_number,
                 from_=self.settings.twilio_phone_number
@@ -208,17 +379,19 @@ class CallService:
             logger.error(f"Error realizando llamada: {e}")
             raise HTTPException(status_code=500, detail=f"Error realizando llamada: {str(e)}")
 
-    def start_conversation_call(self, to_number: str, welcome_message: str = None) -> Dict:
+    async def _disabled_start_conversation_call(self, to_number: str, welcome_message: str = None) -> Dict:
+        """start_conversation_call cuando Twilio no está configurado"""
+        raise HTTPException(status_code=500, detail="Cliente Twilio no configurado")
+
+    async def _real_start_conversation_call(self, to_number: str, welcome_message: str = None) -> Dict:
         """Iniciar llamada conversacional"""
-        if not self.twilio_client:
-            raise HTTPException(status_code=500, detail="Cliente Twilio no configurado")
-        
         try:
             # Crear TwiML conversacional
-            twiml = self.create_conversation_twiml(welcome_message)
+            twiml = await self.create_conversation_twiml(welcome_message)
             
             # Realizar llamada
-            call = self.twilio_client.calls.create(
+            call = await asyncio.to_thread(
+                self.twilio_client.calls.create,
                 twiml=twiml,
                 to=to_number,
                 from_=self.settings.twilio_phone_number
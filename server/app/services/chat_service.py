@@ -2,27 +2,124 @@
 Chat service for managing conversations and message processing
 """
 
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Iterator, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import asyncio
+import base64
 import os
+import time
 import re
-from pypdf import PdfReader
+import threading
+import orjson
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
-from ..core.database import get_db, get_db_context
+from ..core.config import get_settings
+from ..core.database import get_db, DbSession
 from ..core.logging import get_logger
-from ..core.exceptions import ChatHistoryError, ValidationError
+from ..core.exceptions import ChatHistoryError, DatabaseError, ValidationError
 from ..models.user import User
 from ..models.chat import ChatSession, Message, MessageType, MessageDirection, ChatSessionStatus
 from ..repositories.user_repository import UserRepository
 from ..repositories.chat_repository import ChatRepository, MessageRepository
-from ..repositories.agent_repository import AgentRepository
+from ..repositories.agent_repository import get_agent_config_cached
 from .whatsapp_service import WhatsAppService
 from .ollama_service import OllamaService
 from .conversation_service import ConversationService
+from .semantic_cache import SemanticCache
+
+# PyMuPDF parses in C; pypdf stays as the fallback where it is not installed
+try:
+    import fitz
+    PYMUPDF_AVAILABLE = True
+except ImportError:
+    PYMUPDF_AVAILABLE = False
+    fitz = None
+    from pypdf import PdfReader
 
 logger = get_logger(__name__)
 
+# The history window only slides forward in steps of this many messages, so the
+# prompt prefix sent to Ollama stays identical across turns and its KV cache is reused
+HISTORY_TRUNCATE_CHUNK = 10
+
+# SQLEnum columns load as enum members, so history rows can be compared by identity;
+# also bound here so the webhook path skips the enum class lookup
+_INCOMING = MessageDirection.INCOMING
+_OUTGOING = MessageDirection.OUTGOING
+
+# Enum -> wire string, resolved once instead of going through Enum.value per row
+_STATUS_STR = {member: member.value for member in ChatSessionStatus}
+_DIRECTION_STR = {member: member.value for member in MessageDirection}
+_MESSAGE_TYPE_STR = {member: member.value for member in MessageType}
+
+# History messages mentioning these terms are kept out of the AI prompt
+_CONTAMINATION_RE = re.compile(r"seguro|insurance|vive tranqui", re.IGNORECASE)
+
+# [SEND_DOC: url] / [SEND_IMG: url] commands the AI embeds in its reply
+_MEDIA_RE = re.compile(r'\[SEND_(?P<kind>DOC|IMG):\s*(?P<url>.+?)\]')
+_MEDIA_KINDS = {"DOC": "document", "IMG": "image"}
+
+# Characters not allowed by the media endpoint; stripping them also rules out path separators
+_UNSAFE_FILENAME_RE = re.compile(r"[^\w.\- ]+")
+
+# Short-lived results of get_active_sessions keyed by limit: {limit: (expires_at, sessions)}.
+# Message counts may lag by up to the TTL; creating or ending a session clears it.
+ACTIVE_SESSIONS_TTL = 5
+_active_sessions_cache: Dict[int, Any] = {}
+
+
+def invalidate_active_sessions() -> None:
+    """Drop cached get_active_sessions results after the active set changes"""
+    _active_sessions_cache.clear()
+
+# WhatsApp message ids recently stored, so webhook retries are answered from memory
+SEEN_MESSAGE_IDS_MAX = 10_000
+
+# Outbound WhatsApp sends run here so the DB write of the same message overlaps the HTTP call
+_OUTBOUND_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="whatsapp-send")
+
+# PDF extraction gives up once this many pages average fewer than PDF_MIN_CHARS_PER_PAGE
+PDF_SPARSE_PAGES = 5
+PDF_MIN_CHARS_PER_PAGE = 40
+
+# Incoming PDFs are downloaded and parsed here while the webhook resolves user and session
+_MEDIA_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="media-ingest")
+
+
+def _encode_history_cursor(message: Any) -> str:
+    """Opaque keyset cursor pointing just before the given message (entity or row)"""
+    raw = f"{message.timestamp.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_history_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Decode a cursor made by _encode_history_cursor into (timestamp, id)"""
+    try:
+        timestamp, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except ValueError as e:
+        raise ValidationError(f"Invalid history cursor: {cursor}", error_code="INVALID_CURSOR") from e
+
+
+
+def _history_message(row: Any) -> Dict[str, Any]:
+    """Chat history dict for a projected message row"""
+    timestamp = row.timestamp.isoformat() if row.timestamp else None
+    return {
+        "id": row.id,
+        "direction": _DIRECTION_STR[row.direction],
+        "content": row.content,
+        "message_type": _MESSAGE_TYPE_STR[row.message_type],
+        "created_at": row.created_at.isoformat(),
+        "sent_at": timestamp,
+        "received_at": timestamp,
+        "is_read": row.is_read,
+        "is_delivered": row.is_delivered
+    }
+
 
 class ChatService:
     """Service for managing chat conversations and message processing"""
@@ -38,11 +135,6 @@ class ChatService:
         Returns:
             Path to user's media folder
         """
-        # Create base media directory
-        base_dir = "user_documents"
-        if not os.path.exists(base_dir):
-            os.makedirs(base_dir)
-        
         # Create user-specific folder
         # Use name if available, otherwise use phone
         folder_name = user_name if user_name else user_id
@@ -50,10 +142,12 @@ class ChatService:
         folder_name = "".join(c for c in folder_name if c.isalnum() or c in (' ', '-', '_')).strip()
         folder_name = folder_name.replace(" ", "_")
         
-        user_folder = os.path.join(base_dir, folder_name)
-        if not os.path.exists(user_folder):
-            os.makedirs(user_folder)
-            logger.info(f"📁 Created folder for user: {user_folder}")
+        user_folder = os.path.join(self._media_base_dir, folder_name)
+        if user_folder not in self._media_folders:
+            if not os.path.exists(user_folder):
+                os.makedirs(user_folder)
+                logger.info(f"📁 Created folder for user: {user_folder}")
+            self._media_folders.add(user_folder)
         
         return user_folder
     
@@ -62,6 +156,46 @@ class ChatService:
         self.ollama_service = OllamaService()
         self.conversation_service = ConversationService()
         
+        # Base media directory is created once; user folders already known
+        # to exist skip the stat on later messages
+        self._media_base_dir = "user_documents"
+        os.makedirs(self._media_base_dir, exist_ok=True)
+        self._media_folders = set()
+        
+        # LRU of processed WhatsApp message ids; the DB lookup stays as the
+        # fallback for ids seen by other workers or before a restart
+        self._seen_msg_ids: "OrderedDict[str, None]" = OrderedDict()
+        self._seen_msg_lock = threading.Lock()
+        
+        # Cache of AI replies for near-duplicate opening messages
+        settings = get_settings()
+        self._semcache = None
+        if settings.semantic_cache_enabled:
+            self._semcache = SemanticCache(
+                embedding_model=settings.embedding_model,
+                threshold=settings.semantic_cache_threshold,
+                max_entries=settings.semantic_cache_max_entries
+            )
+        
+    def _is_seen_message(self, whatsapp_message_id: Optional[str]) -> bool:
+        """Check whether a WhatsApp message id was already processed by this instance"""
+        if not whatsapp_message_id:
+            return False
+        with self._seen_msg_lock:
+            if whatsapp_message_id in self._seen_msg_ids:
+                self._seen_msg_ids.move_to_end(whatsapp_message_id)
+                return True
+        return False
+    
+    def _mark_message_seen(self, whatsapp_message_id: Optional[str]) -> None:
+        """Remember a processed WhatsApp message id, evicting the oldest when full"""
+        if not whatsapp_message_id:
+            return
+        with self._seen_msg_lock:
+            self._seen_msg_ids[whatsapp_message_id] = None
+            if len(self._seen_msg_ids) > SEEN_MESSAGE_IDS_MAX:
+                self._seen_msg_ids.popitem(last=False)
+    
     def _get_or_create_chat_session(self, user_id: str):
         """
         Get an existing chat session or create a new one
@@ -72,32 +206,52 @@ class ChatService:
         Returns:
             ChatSession object
         """
-        with get_db_context() as db:
-            chat_repo = ChatRepository(db)
-            user_repo = UserRepository(db)
-            
-            # Get or create user
-            user = user_repo.get_by_whatsapp_id(user_id)
-            if not user:
-                user = user_repo.create({
-                    "phone_number": user_id,
-                    "whatsapp_id": user_id,
-                    "name": f"User {user_id[-4:]}",
-                    "is_active": True,
-                    "language": "es"
-                })
-            
-            # Get or create active session
-            active_session = chat_repo.get_active_session_for_user(user.id)
-            if not active_session:
-                session_id = f"session_{user.id}_{int(datetime.utcnow().timestamp())}"
-                active_session = chat_repo.create_session(
-                    user_id=user.id,
-                    session_id=session_id,
-                    ai_personality="isa"
-                )
+        with DbSession() as db:
+            return self._get_or_create_chat_session_db(db, user_id)
+    
+    def _get_or_create_chat_session_db(self, db: Session, user_id: str):
+        """
+        Get an existing chat session or create a new one using an open session
+        
+        Args:
+            db: Database session
+            user_id: User's WhatsApp ID
             
+        Returns:
+            ChatSession object
+        """
+        chat_repo = ChatRepository(db)
+        
+        # Common case: user and active session already exist -> one joined query
+        active_session = chat_repo.get_active_session_for_whatsapp_id(user_id)
+        if active_session:
             return active_session
+        
+        user_repo = UserRepository(db)
+        
+        # Get or create user
+        user = user_repo.get_by_whatsapp_id(user_id)
+        if not user:
+            user = user_repo.create({
+                "phone_number": user_id,
+                "whatsapp_id": user_id,
+                "name": f"User {user_id[-4:]}",
+                "is_active": True,
+                "language": "es"
+            })
+        
+        # Get or create active session
+        active_session = chat_repo.get_active_session_for_user(user.id)
+        if not active_session:
+            session_id = f"session_{user.id}_{time.time_ns()}"
+            active_session = chat_repo.create_session(
+                user_id=user.id,
+                session_id=session_id,
+                ai_personality="isa"
+            )
+            invalidate_active_sessions()
+        
+        return active_session
     
     def _get_conversation_history(self, chat_session_id: int, limit: int = 10) -> List[Dict[str, str]]:
         """
@@ -110,20 +264,46 @@ class ChatService:
         Returns:
             List of message dictionaries with role and content
         """
-        with get_db_context() as db:
-            message_repo = MessageRepository(db)
-            messages = message_repo.get_messages_by_session(
-                chat_session_id=chat_session_id,
-                limit=limit
-            )
+        with DbSession() as db:
+            return self._get_conversation_history_db(db, chat_session_id, limit)[0]
+    
+    def _get_conversation_history_db(
+        self,
+        db: Session,
+        chat_session_id: int,
+        limit: int = 10
+    ) -> Tuple[List[Dict[str, str]], int]:
+        """
+        Get conversation history for a chat session using an open session
+        
+        Args:
+            db: Database session
+            chat_session_id: ID of the chat session
+            limit: Minimum number of recent messages to keep
             
-            return [
-                {
-                    "role": "user" if msg.direction == MessageDirection.INCOMING else "assistant",
-                    "content": msg.content
-                }
-                for msg in messages
-            ]
+        Returns:
+            (list of message dictionaries with role and content, total messages in the session)
+        """
+        message_repo = MessageRepository(db)
+        
+        # Keep between `limit` and `limit + HISTORY_TRUNCATE_CHUNK - 1` messages,
+        # oldest first; the start only moves when a whole chunk can be dropped
+        total = message_repo.count_session_messages(chat_session_id)
+        start = max(0, (total - limit) // HISTORY_TRUNCATE_CHUNK * HISTORY_TRUNCATE_CHUNK)
+        rows = message_repo.get_history_raw(
+            session_id=chat_session_id,
+            skip=start,
+            limit=limit + HISTORY_TRUNCATE_CHUNK
+        )
+        
+        history = [
+            {
+                "role": "user" if direction is _INCOMING else "assistant",
+                "content": content
+            }
+            for direction, content in rows
+        ]
+        return history, total
     
     def _save_message(
         self,
@@ -146,52 +326,174 @@ class ChatService:
             user_id: Optional user ID. If not provided, will try to get it from the chat session
         """
         try:
-            with get_db_context() as db:
-                message_repo = MessageRepository(db)
-                chat_repo = ChatRepository(db)
-                
-                # If user_id is not provided, try to get it from the chat session
-                if user_id is None:
-                    chat_session = chat_repo.get(chat_session_id)
-                    if chat_session:
-                        user_id = chat_session.user_id
-                
-                if user_id is None:
-                    raise ValueError("Could not determine user_id for message")
-                
-                message_repo.create_message(
-                    user_id=user_id,
+            with DbSession() as db:
+                self._save_message_db(
+                    db,
                     chat_session_id=chat_session_id,
                     content=content,
                     direction=direction,
                     message_type=message_type,
-                    whatsapp_message_id=whatsapp_message_id
+                    whatsapp_message_id=whatsapp_message_id,
+                    user_id=user_id
                 )
                 db.commit()
         except Exception as e:
             logger.error(f"Error saving message: {str(e)}")
             raise
     
-    def _extract_text_from_pdf(self, file_path: str) -> Optional[str]:
+    def _save_message_db(
+        self,
+        db: Session,
+        chat_session_id: int,
+        content: str,
+        direction: str,
+        message_type: str = "text",
+        whatsapp_message_id: Optional[str] = None,
+        user_id: Optional[int] = None
+    ) -> Message:
+        """
+        Save a message using an open session (the caller owns the transaction)
+        
+        Args:
+            db: Database session
+            chat_session_id: ID of the chat session
+            content: Message content
+            direction: Message direction (incoming/outgoing)
+            message_type: Type of message (text, image, etc.)
+            whatsapp_message_id: Optional WhatsApp message ID
+            user_id: Optional user ID. If not provided, will try to get it from the chat session
+            
+        Returns:
+            Created Message object
+        """
+        # If user_id is not provided, try to get it from the chat session
+        if user_id is None:
+            user_id = ChatRepository(db).get_user_id(chat_session_id)
+        
+        if user_id is None:
+            raise ValueError("Could not determine user_id for message")
+        
+        return MessageRepository(db).create_message(
+            user_id=user_id,
+            chat_session_id=chat_session_id,
+            content=content,
+            direction=direction,
+            message_type=message_type,
+            whatsapp_message_id=whatsapp_message_id
+        )
+    
+    def _extract_text_from_pdf(self, file_path: str, max_chars: int = 2200) -> Optional[str]:
         """
         Extract text from PDF file
         
         Args:
             file_path: Path to PDF file
+            max_chars: Stop parsing pages once this much text has been collected
             
         Returns:
-            Extracted text or None
+            Extracted text (at most max_chars) or None
         """
         try:
-            reader = PdfReader(file_path)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
-            return text.strip()
+            if PYMUPDF_AVAILABLE:
+                doc = fitz.open(file_path)
+                pages = (page.get_text("text") for page in doc)
+            else:
+                doc = None
+                pages = (page.extract_text() or "" for page in PdfReader(file_path).pages)
+            try:
+                parts = []
+                total = 0
+                for pages_read, text in enumerate(pages, 1):
+                    parts.append(text)
+                    total += len(text) + 1
+                    if total >= max_chars:
+                        break
+                    # Scanned/graphics-heavy documents yield next to no text;
+                    # stop instead of parsing every remaining page
+                    if pages_read >= PDF_SPARSE_PAGES and total < pages_read * PDF_MIN_CHARS_PER_PAGE:
+                        logger.info(f"Stopping PDF extraction after {pages_read} low-text pages")
+                        break
+            finally:
+                if doc is not None:
+                    doc.close()
+            return "\n".join(parts).strip()[:max_chars]
         except Exception as e:
             logger.error(f"Error extracting text from PDF: {str(e)}")
             return None
 
+    def _ingest_pdf(
+        self,
+        user_id: str,
+        contact_name: str,
+        document: Dict[str, Any]
+    ) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+        """
+        Download an incoming PDF and extract its text for the AI prompt
+        
+        Args:
+            user_id: User's phone number
+            contact_name: WhatsApp profile name, used for the media folder
+            document: Document payload from the parsed webhook
+        
+        Returns:
+            (user_message, additional_context, media_metadata)
+        """
+        additional_context = ""
+        media_metadata = None
+        mime_type = document.get("mime_type", "")
+        media_id = document.get("id")
+        filename = document.get("filename", "document.pdf")
+        caption = document.get("caption", "")
+        # Sender-controlled name, sanitized once for both the saved file and the link
+        safe_name = _UNSAFE_FILENAME_RE.sub("_", filename)
+        
+        # Download and extract text
+        media_url = self.whatsapp_service.get_media_url(media_id)
+        if media_url:
+            # Get user-specific folder
+            # The profile name from the webhook; the DB user is resolved later
+            user_folder = self._get_user_media_folder(user_id, contact_name or None)
+            
+            # Save with timestamp for uniqueness
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            file_path = os.path.join(user_folder, f"{timestamp}_{safe_name}")
+            
+            if self.whatsapp_service.download_media(media_url, file_path):
+                logger.info(f"📄 PDF saved to: {file_path}")
+                
+                # Store media metadata for database
+                media_metadata = {
+                    "url": document.get("url", media_url),
+                    "mime_type": mime_type,
+                    "local_path": file_path,
+                    "filename": filename
+                }
+                
+                extracted_text = self._extract_text_from_pdf(file_path, max_chars=2100)
+                if extracted_text:
+                    # Truncate if too long (e.g., 2000 chars)
+                    additional_context = f"\n[SYSTEM: The user sent a PDF document named '{filename}'. Extracted Content: {extracted_text[:2000]}...]"
+                    logger.info(f"Extracted text from PDF {filename}")
+                
+                # Add download link to message content
+                media_link = f"📄 Descargar PDF: /api/v1/media/{media_id}_{safe_name}"
+                if caption:
+                    user_message = f"{caption}\n{media_link}"
+                else:
+                    user_message = f"[PDF: {filename}]\n{media_link}"
+            else:
+                if caption:
+                    user_message = f"{caption} (PDF - download failed)"
+                else:
+                    user_message = f"[PDF: {filename} - download failed]"
+        else:
+            if caption:
+                user_message = f"{caption} (PDF attached)"
+            else:
+                user_message = f"[PDF: {filename}]"
+        
+        return user_message, additional_context, media_metadata
+
     def process_incoming_message(self, webhook_data: Dict[str, Any]) -> Dict[str, Any]:
         """
         Process incoming WhatsApp message
@@ -202,9 +504,13 @@ class ChatService:
         Returns:
             Processing result
         """
+        # Bound once; the handler reaches these on every step of the hot path
+        whatsapp = self.whatsapp_service
+        semcache = self._semcache
+        
         try:
             # Parse webhook message
-            parsed_message = self.whatsapp_service.parse_webhook_message(webhook_data)
+            parsed_message = whatsapp.parse_webhook_message(webhook_data)
             
             if not parsed_message or parsed_message.get("type") == "status":
                 # Handle status updates
@@ -221,64 +527,24 @@ class ChatService:
             
             if not user_id:
                 return {"status": "error", "reason": "Missing user ID"}
+            
+            # Webhook retries are dropped before any download or DB work
+            if self._is_seen_message(whatsapp_message_id):
+                return {"status": "duplicate", "note": "Message already processed"}
 
             # --- Media Handling (Incoming) ---
             additional_context = ""
             media_metadata = None  # Initialize for all message types
             
+            pdf_job = None
+            
             if message_type == "document":
                 document = parsed_message.get("document", {})
-                mime_type = document.get("mime_type", "")
                 
-                if "application/pdf" in mime_type:
-                    media_id = document.get("id")
-                    filename = document.get("filename", "document.pdf")
-                    caption = document.get("caption", "")
-                    
-                    # Download and extract text
-                    media_url = self.whatsapp_service.get_media_url(media_id)
-                    if media_url:
-                        # Get user-specific folder
-                        user_folder = self._get_user_media_folder(user_id, user.name if user else None)
-                        
-                        # Save with timestamp for uniqueness
-                        from datetime import datetime
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        file_path = os.path.join(user_folder, f"{timestamp}_{filename}")
-                        
-                        if self.whatsapp_service.download_media(media_url, file_path):
-                            logger.info(f"📄 PDF saved to: {file_path}")
-                            
-                            # Store media metadata for database
-                            media_metadata = {
-                                "url": document.get("url", media_url),
-                                "mime_type": mime_type,
-                                "local_path": file_path,
-                                "filename": filename
-                            }
-                            
-                            extracted_text = self._extract_text_from_pdf(file_path)
-                            if extracted_text:
-                                # Truncate if too long (e.g., 2000 chars)
-                                additional_context = f"\n[SYSTEM: The user sent a PDF document named '{filename}'. Extracted Content: {extracted_text[:2000]}...]"
-                                logger.info(f"Extracted text from PDF {filename}")
-                            
-                            # Add download link to message content
-                            media_link = f"📄 Descargar PDF: /api/v1/media/{media_id}_{filename}"
-                            if caption:
-                                user_message = f"{caption}\n{media_link}"
-                            else:
-                                user_message = f"[PDF: {filename}]\n{media_link}"
-                        else:
-                            if caption:
-                                user_message = f"{caption} (PDF - download failed)"
-                            else:
-                                user_message = f"[PDF: {filename} - download failed]"
-                    else:
-                        if caption:
-                            user_message = f"{caption} (PDF attached)"
-                        else:
-                            user_message = f"[PDF: {filename}]"
+                if "application/pdf" in document.get("mime_type", ""):
+                    # Download and text extraction run in the background while
+                    # the user and session are resolved below
+                    pdf_job = _MEDIA_POOL.submit(self._ingest_pdf, user_id, contact_name, document)
             
             elif message_type == "image":
                 image = parsed_message.get("image", {})
@@ -289,17 +555,16 @@ class ChatService:
                 logger.info(f"Processing image message with ID: {media_id}")
                 
                 # Download image
-                media_url = self.whatsapp_service.get_media_url(media_id)
+                media_url = whatsapp.get_media_url(media_id)
                 if media_url:
                     # Get user-specific folder
-                    user_folder = self._get_user_media_folder(user_id, user.name if user else None)
+                    user_folder = self._get_user_media_folder(user_id, contact_name or None)
                     
                     # Save with timestamp for uniqueness
-                    from datetime import datetime
                     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                     file_path = os.path.join(user_folder, f"{timestamp}_image.jpg")
                     
-                    if self.whatsapp_service.download_media(media_url, file_path):
+                    if whatsapp.download_media(media_url, file_path):
                         logger.info(f"📷 Image saved to: {file_path}")
                         
                         # Store media metadata for database
@@ -333,25 +598,16 @@ class ChatService:
                     else:
                         user_message = "[Image received]"
                 
-            logger.info(f"Message processed. Type: {message_type}, User: {user_id}, Content: {user_message[:50]}")
-                
-            # Determine next step based on user input (flow vs AI)
-            # Only use flow logic for explicit text commands or if we are not in media mode
-            # For now, let's assume media always goes to AI/Agent unless flow strictly intercepts
-            
-            # Combine message for AI
-            full_user_message = user_message
-            if additional_context:
-                full_user_message += additional_context
-            
             # Get database session
-            with get_db_context() as db:
+            with DbSession() as db:
                 user_repo = UserRepository(db)
                 chat_repo = ChatRepository(db)
                 message_repo = MessageRepository(db)
                 
-                # Get or create user
-                user = user_repo.get_by_phone_number(user_id)
+                # Resolve user + active session once for the whole webhook;
+                # both come back from a single joined query in the common case
+                active_session = chat_repo.get_active_session_for_phone_number(user_id)
+                user = active_session.user if active_session else user_repo.get_by_phone_number(user_id)
                 if not user:
                     whatsapp_id = parsed_message.get("contact", {}).get("wa_id") or user_id
                     user = user_repo.create({
@@ -362,25 +618,41 @@ class ChatService:
                         "language": "es"
                     })
                 else:
-                    user_repo.update_last_activity(user.id)
+                    # Flushed with the incoming message insert below
+                    user.last_activity_date = datetime.utcnow()
                     if contact_name and not user.name:
-                        user_repo.update(user.id, {"name": contact_name})
+                        user.name = contact_name
                 
-                # Get or create active chat session
-                active_session = chat_repo.get_active_session_for_user(user.id)
+                # Create the active chat session if the user had none
                 if not active_session:
-                    session_id = f"session_{user.id}_{int(datetime.utcnow().timestamp())}"
+                    session_id = f"session_{user.id}_{time.time_ns()}"
                     active_session = chat_repo.create_session(
                         user_id=user.id,
                         session_id=session_id,
                         ai_personality="isa"
                     )
+                    invalidate_active_sessions()
                 
                 # Check duplication
                 existing_message = message_repo.get_by_whatsapp_id(whatsapp_message_id)
                 if existing_message:
+                    self._mark_message_seen(whatsapp_message_id)
                     return {"status": "duplicate", "note": "Message already processed"}
                 
+                if pdf_job is not None:
+                    user_message, additional_context, media_metadata = pdf_job.result()
+                
+                logger.info(f"Message processed. Type: {message_type}, User: {user_id}, Content: {user_message[:50]}")
+                
+                # Determine next step based on user input (flow vs AI)
+                # Only use flow logic for explicit text commands or if we are not in media mode
+                # For now, let's assume media always goes to AI/Agent unless flow strictly intercepts
+                
+                # Combine message for AI
+                full_user_message = user_message
+                if additional_context:
+                    full_user_message += additional_context
+                
                 # Save incoming message
                 # Map incoming media type to MessageType enum if possible, or fallback to TEXT/IMAGE
                 # Since we updated models, we trust simple strings or Enum
@@ -396,20 +668,28 @@ class ChatService:
                         "media_filename": media_metadata.get("filename")
                     }
                 
+                # A plain text payload is fully captured by the columns above, so the
+                # raw webhook is only kept for media/other types
+                raw_content = None
+                if message_type != "text":
+                    raw_content = orjson.dumps(parsed_message, default=str).decode()
+                
                 incoming_message = message_repo.create_message(
                     user_id=user.id,
                     chat_session_id=active_session.id,
                     content=user_message, # Display friendly text
-                    direction=MessageDirection.INCOMING,
+                    direction=_INCOMING,
                     message_type=db_message_type,
                     whatsapp_message_id=whatsapp_message_id,
-                    raw_content=str(parsed_message),
+                    raw_content=raw_content,
                     **media_fields
                 )
                 
+                self._mark_message_seen(whatsapp_message_id)
+                
                 # Mark as read
                 try:
-                    self.whatsapp_service.mark_message_as_read(whatsapp_message_id)
+                    whatsapp.mark_message_as_read(whatsapp_message_id)
                 except Exception:
                     pass
                 
@@ -421,12 +701,15 @@ class ChatService:
                 # We use full_user_message (with Context) for AI
                 
                 # Get conversation history
-                history = self._get_conversation_history(active_session.id)
+                history, session_total = self._get_conversation_history_db(db, active_session.id)
+                # Only the opening message of a session (no media) is safe to answer from cache;
+                # decided on the stored count, before the short-history truncation below
+                use_semcache = semcache is not None and not additional_context and session_total == 1
                 # ... history filtering logic ...
                 if history and len(history) <= 2:
                     history = []
                 else:
-                     history = [m for m in history if not any(w in m.get("content","").lower() for w in ["seguro", "insurance", "vive tranqui"])]
+                     history = [m for m in history if not _CONTAMINATION_RE.search(m.get("content") or "")]
                 
                 # Call Ollama
                 # Pass image path if available for vision models
@@ -435,80 +718,91 @@ class ChatService:
                     image_path_for_vision = media_metadata.get("local_path")
                     logger.info(f"🖼️ Passing image to vision model: {image_path_for_vision}")
                 
-                response = self.ollama_service.generate_response(
-                    user_message=full_user_message,
-                    conversation_history=history,
-                    user_context={
-                        "phone": user_id,
-                        "name": user.name
-                    },
-                    conversation_state={"current_step": "ai_conversation"},
-                    image_path=image_path_for_vision
-                )
+                conversation_state = {"current_step": "ai_conversation"}
+                
+                # Replies are only shared between users of the same model and step
+                cache_namespace = (self.ollama_service.model, conversation_state["current_step"])
+                cached_response, cache_embedding = None, None
+                if use_semcache:
+                    cached_response, cache_embedding = semcache.lookup(cache_namespace, full_user_message)
+                
+                if cached_response:
+                    response = cached_response
+                else:
+                    response = self.ollama_service.generate_response(
+                        user_message=full_user_message,
+                        conversation_history=history,
+                        user_context={
+                            "phone": user_id,
+                            "name": user.name
+                        },
+                        conversation_state=conversation_state,
+                        image_path=image_path_for_vision
+                    )
+                    # Personalized replies (name in the text) are never shared across users
+                    if use_semcache and not (user.name and user.name in (response or "")):
+                        semcache.store(cache_namespace, full_user_message, cache_embedding, response)
                 
                 if not response:
                     return {"status": "error", "error": "Empty AI response"}
                 
                 # --- Media Handling (Outgoing / Hands) ---
                 # Check for [SEND_DOC: url] or [SEND_IMG: url] commands
-                # Regex patterns
-                doc_pattern = r'\[SEND_DOC:\s*(.+?)\]'
-                img_pattern = r'\[SEND_IMG:\s*(.+?)\]'
-                
                 media_sends = []
                 
-                # Find documents
-                for match in re.finditer(doc_pattern, response):
-                    url = match.group(1).strip()
-                    media_sends.append({"type": "document", "url": url})
+                def _collect_media(match):
+                    media_sends.append({"type": _MEDIA_KINDS[match["kind"]], "url": match["url"].strip()})
+                    return ""
                 
-                # Find images
-                for match in re.finditer(img_pattern, response):
-                    url = match.group(1).strip()
-                    media_sends.append({"type": "image", "url": url})
+                # Collect the commands and strip them from the text in one pass
+                clean_response = _MEDIA_RE.sub(_collect_media, response).strip()
                 
-                # Remove tags from response text
-                clean_response = re.sub(doc_pattern, '', response)
-                clean_response = re.sub(img_pattern, '', clean_response).strip()
+                def _outgoing_row(content, message_type):
+                    return {
+                        "content": content,
+                        "message_type": message_type,
+                        "user_id": user.id,
+                        "chat_session_id": active_session.id,
+                        "direction": _OUTGOING
+                    }
                 
-                # Send Text Response (if any remains)
+                # Send Text Response (if any remains); it lands before its attachments
+                # and is only recorded once delivered
                 if clean_response:
-                    self.whatsapp_service.send_text_message(user_id, clean_response)
-                    
-                    # Save text message
-                    self._save_message(
-                        chat_session_id=active_session.id,
-                        content=clean_response,
-                        direction=MessageDirection.OUTGOING,
-                        message_type="text",
-                        user_id=user.id
-                    )
+                    whatsapp.send_text_message(user_id, clean_response)
+                    message_repo.create_messages([_outgoing_row(clean_response, "text")])
                 
-                # Send Media Files
+                # Send Media Files; they don't depend on each other and go out concurrently
+                attachment_sends = []
                 for media in media_sends:
                     if media["type"] == "document":
                         # Attempt to derive filename from url or default
                         filename = media["url"].split("/")[-1] or "document.pdf"
-                        self.whatsapp_service.send_document_message(user_id, media["url"], filename=filename)
-                        
-                        self._save_message(
-                            chat_session_id=active_session.id,
-                            content=f"[Sent Document: {filename}]",
-                            direction=MessageDirection.OUTGOING,
-                            message_type="document",
-                            user_id=user.id
-                        )
+                        attachment_sends.append((
+                            _OUTBOUND_POOL.submit(
+                                whatsapp.send_document_message, user_id, media["url"], filename=filename
+                            ),
+                            _outgoing_row(f"[Sent Document: {filename}]", "document")
+                        ))
                         
                     elif media["type"] == "image":
-                        self.whatsapp_service.send_image_message(user_id, media["url"])
-                        
-                        self._save_message(
-                            chat_session_id=active_session.id,
-                            content=f"[Sent Image]",
-                            direction=MessageDirection.OUTGOING,
-                            message_type="image",
-                            user_id=user.id
-                        )
+                        attachment_sends.append((
+                            _OUTBOUND_POOL.submit(whatsapp.send_image_message, user_id, media["url"]),
+                            _outgoing_row("[Sent Image]", "image")
+                        ))
+                
+                # Only attachments that actually went out are recorded
+                sent_rows = []
+                send_error = None
+                for attachment_sent, row in attachment_sends:
+                    try:
+                        attachment_sent.result()
+                        sent_rows.append(row)
+                    except Exception as e:
+                        send_error = send_error or e
+                message_repo.create_messages(sent_rows)
+                if send_error:
+                    raise send_error
                 
                 return {"status": "success", "response": clean_response}
 
@@ -519,12 +813,26 @@ class ChatService:
                     
 
     
+    async def process_incoming_message_async(self, webhook_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Process incoming WhatsApp message without blocking the event loop
+        
+        Args:
+            webhook_data: Raw webhook data from WhatsApp
+            
+        Returns:
+            Processing result
+        """
+        return await asyncio.to_thread(self.process_incoming_message, webhook_data)
+    
     def _generate_ai_response(
         self,
         user: User,
         session: ChatSession,
         user_message: str,
-        db: Session
+        db: Session,
+        conversation_history: Optional[List[Dict[str, Any]]] = None,
+        conversation_state: Optional[Dict[str, Any]] = None
     ) -> Optional[str]:
         """
         Generate AI response using Ollama with conversation flow context
@@ -534,24 +842,24 @@ class ChatService:
             session: Chat session
             user_message: User's message
             db: Database session
+            conversation_history: History already loaded by the caller (optional)
+            conversation_state: Conversation state already resolved by the caller (optional)
             
         Returns:
             AI generated response or None if failed
         """
         try:
-            message_repo = MessageRepository(db)
-            agent_repo = AgentRepository(db)
-            
-            # Get conversation context (last 10 messages)
-            conversation_history = message_repo.get_conversation_context(
-                session.id, max_messages=10
-            )
+            # Get conversation context (last 10 messages) unless the caller has it
+            if conversation_history is None:
+                conversation_history = MessageRepository(db).get_conversation_context(
+                    session.id, max_messages=10
+                )
             
             # Get current conversation state
-            conversation_state = self.conversation_service.conversation_states.get(
-                str(user.id), 
-                {"current_step": "initial_greeting", "data": {}}
-            )
+            if conversation_state is None:
+                conversation_state = self.conversation_service.find_conversation_state(
+                    str(user.id)
+                ) or {"current_step": "initial_greeting", "data": {}}
             
             # Prepare user context with conversation state
             user_context = {
@@ -575,22 +883,15 @@ class ChatService:
                 user_context["meeting"] = meeting_info
             
             # Attach agent workflow configuration if available
-            agent = None
+            agent_config = None
             try:
-                agent = agent_repo.get_by_ollama_model_name(self.ollama_service.model)
+                agent_config = get_agent_config_cached(self.ollama_service.model)
             except Exception as e:
                 logger.warning(f"Unable to fetch agent configuration for model {self.ollama_service.model}: {e}")
             
-            if agent:
+            if agent_config:
                 user_context.setdefault("agent", {})
-                user_context["agent"].update({
-                    "id": agent.id,
-                    "name": agent.name,
-                    "description": agent.description,
-                    "conversation_style": agent.conversation_style,
-                    "workflow_steps": agent.workflow_steps,
-                    "conversation_structure": agent.conversation_structure
-                })
+                user_context["agent"].update(agent_config)
             
             # Generate AI response
             ai_response = self.ollama_service.generate_response(
@@ -619,7 +920,7 @@ class ChatService:
             if not message_id or not status:
                 return
             
-            with get_db_context() as db:
+            with DbSession() as db:
                 message_repo = MessageRepository(db)
                 
                 if status == "delivered":
@@ -654,7 +955,7 @@ class ChatService:
                 formatted_phone, message
             )
             
-            with get_db_context() as db:
+            with DbSession() as db:
                 user_repo = UserRepository(db)
                 chat_repo = ChatRepository(db)
                 message_repo = MessageRepository(db)
@@ -678,6 +979,7 @@ class ChatService:
                         "status": ChatSessionStatus.ACTIVE,
                         "started_at": datetime.utcnow()
                     })
+                    invalidate_active_sessions()
                 
                 # Save outgoing message
                 outgoing_message = message_repo.create({
@@ -686,10 +988,10 @@ class ChatService:
                     "direction": MessageDirection.OUTGOING,
                     "message_type": MessageType.TEXT,
                     "content": message,
-                    "raw_content": str({
+                    "raw_content": orjson.dumps({
                         "whatsapp_response": whatsapp_response,
                         "manual_send": True
-                    }),
+                    }, default=str).decode(),
                     "timestamp": datetime.utcnow(),
                     "user_id": user.id  # Required field
                 })
@@ -736,7 +1038,7 @@ class ChatService:
                 parameters=parameters
             )
             
-            with get_db_context() as db:
+            with DbSession() as db:
                 user_repo = UserRepository(db)
                 chat_repo = ChatRepository(db)
                 message_repo = MessageRepository(db)
@@ -755,13 +1057,14 @@ class ChatService:
                 # Get or create active session
                 active_session = chat_repo.get_active_session_for_user(user.id)
                 if not active_session:
-                    session_id = f"session_{user.id}_{int(datetime.utcnow().timestamp())}"
+                    session_id = f"session_{user.id}_{time.time_ns()}"
                     active_session = chat_repo.create_session(
                         user_id=user.id,
                         session_id=session_id,
                         ai_personality="ana",
                         channel="whatsapp"
                     )
+                    invalidate_active_sessions()
                 
                 # Save outgoing message
                 content = f"[Template: {template_name}]"
@@ -774,12 +1077,12 @@ class ChatService:
                     "direction": MessageDirection.OUTGOING,
                     "message_type": MessageType.TEMPLATE,
                     "content": content,
-                    "raw_content": str({
+                    "raw_content": orjson.dumps({
                         "whatsapp_response": whatsapp_response,
                         "template_name": template_name,
                         "parameters": parameters,
                         "bulk_send": True
-                    }),
+                    }, default=str).decode(),
                     "timestamp": datetime.utcnow(),
                     "user_id": user.id
                 })
@@ -795,11 +1098,122 @@ class ChatService:
             logger.error(f"Send template message error: {str(e)}")
             raise
     
+    def send_template_messages_bulk(
+        self,
+        phone_numbers: List[str],
+        template_name: str,
+        language_code: str = "es",
+        parameters: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
+        """
+        Send a template message to many users and record it in one transaction
+        
+        Users, active sessions and messages are looked up and created for all
+        recipients at once instead of once per recipient.
+        
+        Args:
+            phone_numbers: Recipient phone numbers
+            template_name: Template name
+            language_code: Language code (default: es)
+            parameters: Template parameters
+            
+        Returns:
+            Dict with successful phone numbers, failed entries and error strings
+        """
+        successful = []
+        failed = []
+        errors = []
+        # (formatted phone, WhatsApp API response) per successful send
+        sent: List[Tuple[str, Dict[str, Any]]] = []
+        
+        for phone_number in phone_numbers:
+            try:
+                formatted_phone = self.whatsapp_service.validate_phone_number(phone_number)
+                sent.append((formatted_phone, self.whatsapp_service.send_template_message(
+                    to=formatted_phone,
+                    template_name=template_name,
+                    language_code=language_code,
+                    parameters=parameters
+                )))
+                successful.append(phone_number)
+            except Exception as e:
+                failed.append({"phone_number": phone_number, "error": str(e)})
+                errors.append(f"{phone_number}: {str(e)}")
+                logger.error(f"Failed to send template to {phone_number}: {str(e)}")
+        
+        if not sent:
+            return {"successful": successful, "failed": failed, "errors": errors}
+        
+        content = f"[Template: {template_name}]"
+        if parameters:
+            content += f" Params: {', '.join(parameters)}"
+        
+        with DbSession() as db:
+            user_repo = UserRepository(db)
+            chat_repo = ChatRepository(db)
+            message_repo = MessageRepository(db)
+            
+            # Users: one upsert returning the id of every recipient, new or existing
+            phones = list(dict.fromkeys(phone for phone, _ in sent))
+            user_ids_by_phone = user_repo.upsert_by_phone_numbers([
+                {
+                    "phone_number": phone,
+                    "whatsapp_id": phone,
+                    "name": f"User {phone[-4:]}",
+                    "is_active": True,
+                    "language": language_code
+                }
+                for phone in phones
+            ])
+            
+            # Active sessions: one IN lookup, one INSERT for the missing ones, one re-read
+            user_ids = list(dict.fromkeys(user_ids_by_phone[phone] for phone in phones))
+            sessions = chat_repo.get_active_sessions_for_users(user_ids)
+            missing_user_ids = [user_id for user_id in user_ids if user_id not in sessions]
+            if missing_user_ids:
+                now = datetime.utcnow()
+                chat_repo.insert_many([
+                    {
+                        "user_id": user_id,
+                        "session_id": f"session_{user_id}_{time.time_ns()}",
+                        "channel": "whatsapp",
+                        "ai_personality": "ana",
+                        "started_at": now,
+                        "last_activity_at": now
+                    }
+                    for user_id in missing_user_ids
+                ])
+                sessions.update(chat_repo.get_active_sessions_for_users(missing_user_ids))
+                invalidate_active_sessions()
+            
+            # Messages: one executemany INSERT, and the single commit for the batch
+            message_repo.create_messages([
+                {
+                    "user_id": user_ids_by_phone[phone],
+                    "chat_session_id": sessions[user_ids_by_phone[phone]].id,
+                    "whatsapp_message_id": whatsapp_response.get("messages", [{}])[0].get("id"),
+                    "direction": _OUTGOING,
+                    "message_type": MessageType.TEMPLATE,
+                    "content": content,
+                    "raw_content": orjson.dumps({
+                        "whatsapp_response": whatsapp_response,
+                        "template_name": template_name,
+                        "parameters": parameters,
+                        "bulk_send": True
+                    }, default=str).decode()
+                }
+                for phone, whatsapp_response in sent
+            ])
+        
+        return {"successful": successful, "failed": failed, "errors": errors}
+    
     def get_chat_history(
         self,
         phone_number: str,
         limit: int = 50,
-        offset: int = 0
+        offset: int = 0,
+        before_cursor: Optional[str] = None,
+        include_total: bool = False
     ) -> Dict[str, Any]:
         """
         Get chat history for a user
@@ -807,7 +1221,9 @@ class ChatService:
         Args:
             phone_number: User phone number
             limit: Number of messages to retrieve
-            offset: Offset for pagination
+            offset: Offset for pagination (kept for page jumps; prefer before_cursor)
+            before_cursor: next_cursor of the previous page, for keyset pagination
+            include_total: Also count all of the user's messages (extra aggregate work)
             
         Returns:
             Chat history data
@@ -815,7 +1231,7 @@ class ChatService:
         try:
             formatted_phone = self.whatsapp_service.validate_phone_number(phone_number)
             
-            with get_db_context() as db:
+            with DbSession(readonly=True) as db:
                 user_repo = UserRepository(db)
                 message_repo = MessageRepository(db)
                 
@@ -827,14 +1243,29 @@ class ChatService:
                         "total": 0
                     }
                 
-                messages = message_repo.get_user_messages(
-                    user.id, limit=limit, offset=offset
+                # One row past the page tells whether older messages exist
+                before = _decode_history_cursor(before_cursor) if before_cursor else None
+                messages = message_repo.get_user_messages_projected(
+                    user.id,
+                    limit=limit + 1,
+                    offset=offset,
+                    before=before,
+                    with_total=include_total and before is None
                 )
                 
-                total_messages = message_repo.count_user_messages(user.id)
+                total_messages = None
+                if include_total:
+                    if messages and before is None:
+                        total_messages = messages[0].total
+                    elif before is not None or offset:
+                        # Keyset pages and pages past the end carry no window total
+                        total_messages = message_repo.count_user_messages(user.id)
+                    else:
+                        total_messages = 0
                 
-                # Reverse messages to return them in chronological order (oldest first)
-                messages = messages[::-1]
+                has_more = len(messages) > limit
+                messages = messages[:limit]
+                next_cursor = _encode_history_cursor(messages[-1]) if has_more else None
                 
                 return {
                     "user": {
@@ -845,29 +1276,79 @@ class ChatService:
                         "total_messages": user.total_messages,
                         "last_activity": user.last_activity_date.isoformat() if user.last_activity_date else None
                     },
-                    "messages": [
-                        {
-                            "id": msg.id,
-                            "direction": msg.direction.value,
-                            "content": msg.content,
-                            "message_type": msg.message_type.value,
-                            "created_at": msg.created_at.isoformat(),
-                            "sent_at": msg.timestamp.isoformat() if msg.timestamp else None,
-                            "received_at": msg.timestamp.isoformat() if msg.timestamp else None,
-                            "is_read": msg.is_read,
-                            "is_delivered": msg.is_delivered
-                        }
-                        for msg in messages
-                    ],
+                    # Walk the newest-first page backwards: chronological order, no reversed copy
+                    "messages": [_history_message(row) for row in reversed(messages)],
                     "total": total_messages,
                     "limit": limit,
-                    "offset": offset
+                    "offset": offset,
+                    "has_more": has_more,
+                    "next_cursor": next_cursor
                 }
                 
-        except Exception as e:
-            error_msg = f"Error getting chat history for {phone_number}: {str(e)}"
-            logger.error(error_msg)
-            raise ChatHistoryError(error_msg, error_code="GET_HISTORY_FAILED")
+        except (DatabaseError, SQLAlchemyError) as e:
+            logger.error("Error getting chat history for %s: %s", phone_number, e)
+            raise ChatHistoryError(
+                f"Error getting chat history for {phone_number}: {e}",
+                error_code="GET_HISTORY_FAILED"
+            ) from e
+    
+    def stream_chat_history(self, phone_number: str) -> Iterator[Dict[str, Any]]:
+        """
+        Stream a user's whole chat history (oldest first) for exports
+        
+        The phone number is validated up front; messages are then read from the
+        DB cursor in batches, so memory stays flat however long the history is.
+        
+        Args:
+            phone_number: User phone number
+            
+        Returns:
+            Iterator of message dictionaries (empty if the user does not exist)
+        """
+        formatted_phone = self.whatsapp_service.validate_phone_number(phone_number)
+        
+        def messages() -> Iterator[Dict[str, Any]]:
+            with DbSession(readonly=True) as db:
+                user = UserRepository(db).get_by_phone_number(formatted_phone)
+                if not user:
+                    return
+                for row in MessageRepository(db).iter_user_messages_projected(user.id):
+                    yield _history_message(row)
+        
+        return messages()
+    
+    def iter_active_sessions(self, limit: int = 20) -> Iterator[Dict[str, Any]]:
+        """
+        Stream active chat sessions from the DB cursor without building a list
+        
+        Args:
+            limit: Number of sessions to retrieve
+            
+        Yields:
+            Active session dictionaries
+        """
+        with DbSession(readonly=True) as db:
+            chat_repo = ChatRepository(db)
+            
+            # Unpack each row once (UNPACK_SEQUENCE) instead of eight indexed reads;
+            # the constant-key dict literals compile to a single BUILD_CONST_KEY_MAP
+            for (session_id, user_id, phone_number, name,
+                 started_at, last_activity_at, message_count, status) in chat_repo.iter_sessions_with_messages(
+                status=ChatSessionStatus.ACTIVE,
+                limit=limit
+            ):
+                yield {
+                    "session_id": session_id,
+                    "user": {
+                        "id": user_id,
+                        "phone_number": phone_number,
+                        "name": name
+                    },
+                    "started_at": started_at,
+                    "last_message_at": last_activity_at,
+                    "message_count": message_count,
+                    "status": _STATUS_STR[status]
+                }
     
     def get_active_sessions(self, limit: int = 20) -> List[Dict[str, Any]]:
         """
@@ -879,32 +1360,22 @@ class ChatService:
         Returns:
             List of active sessions
         """
+        cached = _active_sessions_cache.get(limit)
+        if cached and cached[0] > time.monotonic():
+            # Copies, so a caller editing its result can't change what others get
+            return [dict(session) for session in cached[1]]
+        
         try:
-            with get_db_context() as db:
-                chat_repo = ChatRepository(db)
-                
-                sessions = chat_repo.get_sessions_with_messages(
-                    status=ChatSessionStatus.ACTIVE,
-                    limit=limit
-                )
-                
-                return [
-                    {
-                        "session_id": session.id,
-                        "user": {
-                            "id": session.user.id,
-                            "phone_number": session.user.phone_number,
-                            "name": session.user.name
-                        },
-                        "started_at": session.started_at.isoformat() if session.started_at else None,
-                        "last_message_at": session.last_message_at.isoformat() if session.last_message_at else None,
-                        "message_count": session.message_count,
-                        "status": session.status.value
-                    }
-                    for session in sessions
-                ]
-                
-        except Exception as e:
-            error_msg = f"Error getting active sessions: {str(e)}"
-            logger.error(error_msg)
-            raise ChatHistoryError(error_msg, error_code="GET_SESSIONS_FAILED")
\ No newline at end of file
+            result = list(self.iter_active_sessions(limit))
+        except (DatabaseError, SQLAlchemyError) as e:
+            logger.error("Error getting active sessions: %s", e)
+            raise ChatHistoryError(
+                f"Error getting active sessions: {e}",
+                error_code="GET_SESSIONS_FAILED"
+            ) from e
+        
+        _active_sessions_cache[limit] = (
+            time.monotonic() + ACTIVE_SESSIONS_TTL,
+            [dict(session) for session in result]
+        )
+        return result
@@ -2,44 +2,161 @@
 Service for managing conversation state and flow
 """
 
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple, NamedTuple
 from datetime import datetime
-import json
+from functools import lru_cache
 import os
+import time
 from pathlib import Path
 
+import orjson
+
+try:
+    from redis import Redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+    Redis = None
+
 from ..core.logging import get_logger
-from ..config.conversation_flows import get_flow, DEFAULT_ISA_FLOW
+from ..core.settings import get_settings
+from ..config.conversation_flows import get_flow
 
 logger = get_logger(__name__)
 
+# Idle conversation states expire from Redis after this many seconds
+CONVERSATION_STATE_TTL = 86400
+
+# Flow directory listings are reused for this many seconds: {flows_dir: (expires_at, names)}
+FLOW_LIST_TTL = 5
+_flow_list_cache: Dict[str, Tuple[float, List[str]]] = {}
+
+
+def _utc_iso() -> str:
+    """Current UTC time as the ISO string stored in conversation state"""
+    return datetime.utcnow().isoformat()
+
+
+@lru_cache(maxsize=32)
+def _load_flow_cached(path: str, mtime_ns: int) -> Dict[str, Any]:
+    """
+    Parse a flow file once per modification time
+    
+    The returned dict is shared between callers and must not be mutated.
+    """
+    return orjson.loads(Path(path).read_bytes())
+
+class _StepRec(NamedTuple):
+    """One flow step, parsed once so the per-turn code does attribute reads instead of dict probes"""
+    message: Optional[str]
+    next_step_str: Optional[str]
+    next_step_map: Optional[Dict[str, str]]
+    field: Optional[str]
+    questions: Optional[List[Dict[str, Any]]]
+    has_options: bool
+    is_end: bool
+
+
+_EMPTY_STEP = _StepRec(None, None, None, None, None, False, False)
+_DEFAULT_GREETING = "¡Hola! ¿En qué puedo ayudarte hoy?"
+
+
+def _compile_steps(flow: Dict[str, Any]) -> Dict[str, _StepRec]:
+    """Build the step dispatch table for a flow"""
+    steps = {}
+    for name, step_data in flow.items():
+        if not isinstance(step_data, dict):
+            continue
+        next_step = step_data.get("next_step")
+        steps[name] = _StepRec(
+            message=step_data.get("message"),
+            next_step_str=next_step if isinstance(next_step, str) else None,
+            next_step_map=next_step if isinstance(next_step, dict) else None,
+            field=step_data.get("field"),
+            questions=step_data.get("questions"),
+            has_options="options" in step_data,
+            is_end=bool(step_data.get("end", False))
+        )
+    return steps
+
+
 class ConversationService:
     """Service for managing conversation state and flow"""
     
-    def __init__(self, conversation_flow: str = "ema"):
+    def __init__(self, conversation_flow: str = "ema", redis_client: Optional["Redis"] = None):
         """
         Initialize conversation service with a specific flow
         
         Args:
             conversation_flow: Name of the conversation flow to use (default: 'ema')
+            redis_client: Redis client for shared state (default: built from REDIS_URL)
         """
         self.flow = get_flow(conversation_flow)
-        self.conversation_states = {}
+        self._steps = _compile_steps(self.flow)
         self.flows_dir = Path("conversation_flows")
         self.flows_dir.mkdir(exist_ok=True)
         
+        # State is shared across workers (one hash per user, with TTL) when Redis
+        # is configured; otherwise it lives in this process
+        self.redis = redis_client
+        redis_url = get_settings().redis_url
+        if self.redis is None and redis_url:
+            if REDIS_AVAILABLE:
+                self.redis = Redis.from_url(redis_url)
+            else:
+                logger.warning("REDIS_URL is set but the redis package is not installed")
+        self.conversation_states: Dict[str, Dict[str, Any]] = {}
+    
+    @staticmethod
+    def _state_key(user_id: str) -> str:
+        return f"chat_state:{user_id}"
+    
+    def find_conversation_state(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Get the conversation state for a user, or None if there is none"""
+        if self.redis is None:
+            return self.conversation_states.get(user_id)
+        raw = self.redis.hgetall(self._state_key(user_id))
+        if not raw:
+            return None
+        return {field.decode(): orjson.loads(value) for field, value in raw.items()}
+    
+    def save_conversation_state(self, user_id: str, state: Dict[str, Any]) -> None:
+        """Replace the stored conversation state for a user"""
+        if self.redis is None:
+            self.conversation_states[user_id] = state
+            return
+        key = self._state_key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping={field: orjson.dumps(value) for field, value in state.items()})
+        pipe.expire(key, CONVERSATION_STATE_TTL)
+        pipe.execute()
+        
     def get_conversation_state(self, user_id: str) -> Dict[str, Any]:
         """Get or initialize conversation state for a user"""
-        if user_id not in self.conversation_states:
+        state = self.find_conversation_state(user_id)
+        if state is None:
             return self.initialize_conversation(user_id)
-        return self.conversation_states[user_id]
+        return state
         
     def update_conversation_state(self, user_id: str, updates: Dict[str, Any]) -> None:
         """Update conversation state for a user"""
-        if user_id not in self.conversation_states:
-            self.initialize_conversation(user_id)
-        self.conversation_states[user_id].update(updates)
-        self.conversation_states[user_id]["last_updated"] = datetime.utcnow().isoformat()
+        now = updates.get("last_updated") or _utc_iso()
+        updates = {**updates, "last_updated": now}
+        if self.redis is None:
+            if user_id not in self.conversation_states:
+                self.conversation_states[user_id] = self._new_state(now)
+            self.conversation_states[user_id].update(updates)
+            return
+        # Only the changed fields are written; HSETNX fills in a fresh state's
+        # defaults in the same round trip if the user had none
+        key = self._state_key(user_id)
+        pipe = self.redis.pipeline()
+        for field, value in self._new_state(now).items():
+            pipe.hsetnx(key, field, orjson.dumps(value))
+        pipe.hset(key, mapping={field: orjson.dumps(value) for field, value in updates.items()})
+        pipe.expire(key, CONVERSATION_STATE_TTL)
+        pipe.execute()
         
     def get_next_step(self, user_id: str, user_input: str) -> Dict[str, Any]:
         """
@@ -54,7 +171,7 @@ class ConversationService:
         """
         state = self.get_conversation_state(user_id)
         current_step = state.get("current_step", "initial_greeting")
-        step_data = self.flow.get(current_step, {})
+        step = self._steps.get(current_step, _EMPTY_STEP)
         
         # Initialize response
         response = {"message": None, "next_step": None, "data": state.get("data", {})}
@@ -62,14 +179,16 @@ class ConversationService:
         # Handle initial greeting - go directly to AI conversation
         if current_step == "initial_greeting":
             # Move directly to AI conversation, let the AI model handle everything
+            now = _utc_iso()
             updated_data = {
                 **state.get("data", {}),
                 "conversation_started": True,
-                "start_timestamp": datetime.utcnow().isoformat()
+                "start_timestamp": now
             }
             self.update_conversation_state(user_id, {
                 "current_step": "ai_conversation",
-                "data": updated_data
+                "data": updated_data,
+                "last_updated": now
             })
             response["message"] = None  # Let AI handle the greeting
             response["next_step"] = "ai_conversation"
@@ -83,16 +202,14 @@ class ConversationService:
             return response
             
         # For any other steps, just return the message if it exists
-        if "message" in step_data:
-            response["message"] = step_data["message"]
+        if step.message is not None:
+            response["message"] = step.message
             
             # Update next step if specified
-            if "next_step" in step_data:
-                next_step = step_data["next_step"]
-                if isinstance(next_step, dict):
-                    response["next_step"] = next_step.get(user_input.lower())
-                else:
-                    response["next_step"] = next_step
+            if step.next_step_map is not None:
+                response["next_step"] = step.next_step_map.get(user_input.lower())
+            elif step.next_step_str is not None:
+                response["next_step"] = step.next_step_str
         
         # Update conversation state if we have a next step
         if response["next_step"]:
@@ -110,68 +227,18 @@ class ConversationService:
         Returns:
             Initial conversation state
         """
-        self.conversation_states[user_id] = {
+        state = self._new_state(_utc_iso())
+        self.save_conversation_state(user_id, state)
+        return state
+    
+    @staticmethod
+    def _new_state(now: str) -> Dict[str, Any]:
+        return {
             "current_step": "initial_greeting",
             "data": {},
-            "start_time": datetime.utcnow().isoformat(),
-            "last_updated": datetime.utcnow().isoformat()
+            "start_time": now,
+            "last_updated": now
         }
-        return self.conversation_states[user_id]
-    
-    def list_available_flows(self) -> List[str]:
-        """
-        List all available conversation flow files
-        
-        Returns:
-            List of flow names
-        """
-        try:
-            # Get all JSON files in the flows directory
-            flow_files = list(self.flows_dir.glob("*.json"))
-            # Return filenames without extension
-            return [f.stem for f in flow_files]
-        except Exception as e:
-            logger.error(f"Error listing flows: {str(e)}")
-            return []
-    
-    def load_flow_from_file(self, flow_name: str) -> Dict[str, Any]:
-        """
-        Load a conversation flow from a JSON file
-        
-        Args:
-            flow_name: Name of the flow to load (without .json extension)
-            
-        Returns:
-            Dictionary containing the flow configuration
-            
-        Raises:
-            FileNotFoundError: If the flow file doesn't exist
-        """
-        flow_path = self.flows_dir / f"{flow_name}.json"
-        if not flow_path.exists():
-            # If the flow doesn't exist, return the default EMA flow
-            if flow_name == "ema":
-                return DEFAULT_ISA_FLOW
-            raise FileNotFoundError(f"Flow '{flow_name}' not found")
-            
-        with open(flow_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    
-    def save_flow_to_file(self, flow_name: str, flow_data: Dict[str, Any]) -> Path:
-        """
-        Save a conversation flow to a JSON file
-        
-        Args:
-            flow_name: Name of the flow to save
-            flow_data: Flow configuration data
-            
-        Returns:
-            Path to the saved flow file
-        """
-        flow_path = self.flows_dir / f"{flow_name}.json"
-        with open(flow_path, 'w', encoding='utf-8') as f:
-            json.dump(flow_data, f, indent=2, ensure_ascii=False)
-        return flow_path
     
     def get_next_message(self, user_id: str, user_input: Optional[str] = None) -> Dict[str, Any]:
         """
@@ -184,80 +251,77 @@ class ConversationService:
         Returns:
             Dict containing the message and next step information
         """
-        if user_id not in self.conversation_states:
-            self.initialize_conversation(user_id)
-        
-        state = self.conversation_states[user_id]
+        state = self.get_conversation_state(user_id)
         current_step = state["current_step"]
         
         # Update last activity timestamp
-        state["last_updated"] = datetime.utcnow().isoformat()
+        state["last_updated"] = _utc_iso()
         
         # Handle user input if provided
         if user_input is not None:
-            self._process_user_input(user_id, current_step, user_input)
+            self._process_user_input(state, current_step, user_input)
         
         # Get next step
         next_step = self._get_next_step(user_id, current_step, user_input)
         
         # Update state
         state["current_step"] = next_step
+        self.save_conversation_state(user_id, state)
         
         # Get message for next step
-        step_data = self.flow.get(next_step, {"message": "¡Hola! ¿En qué puedo ayudarte hoy?"})
+        step = self._steps.get(next_step, _EMPTY_STEP)
         
         return {
-            "message": step_data.get("message", "¡Hola! ¿En qué puedo ayudarte hoy?"),
+            "message": step.message if step.message is not None else _DEFAULT_GREETING,
             "step": next_step,
-            "requires_input": not step_data.get("end", False),
-            "is_end": step_data.get("end", False),
+            "requires_input": not step.is_end,
+            "is_end": step.is_end,
             "data": state["data"]
         }
     
-    def _process_user_input(self, user_id: str, current_step: str, user_input: str) -> None:
-        """Process and store user input based on current step"""
-        step_data = self.flow.get(current_step, {})
+    def _process_user_input(self, state: Dict[str, Any], current_step: str, user_input: str) -> None:
+        """Process and store user input in the given state based on current step"""
+        step = self._steps.get(current_step, _EMPTY_STEP)
         
         # Handle data collection if specified in the flow
-        if "field" in step_data:
-            field = step_data["field"]
-            self.conversation_states[user_id]["data"][field] = user_input
+        if step.field is not None:
+            state["data"][step.field] = user_input
         
         # Handle multiple questions in a step
-        if "questions" in step_data:
-            question_index = self.conversation_states[user_id].get("question_index", 0)
-            questions = step_data["questions"]
+        if step.questions is not None:
+            question_index = state.get("question_index", 0)
+            questions = step.questions
             
             if question_index < len(questions):
                 field = questions[question_index].get("field")
                 if field:
-                    self.conversation_states[user_id]["data"][field] = user_input
+                    state["data"][field] = user_input
                 
                 # Move to next question or next step
                 if question_index < len(questions) - 1:
-                    self.conversation_states[user_id]["question_index"] = question_index + 1
+                    state["question_index"] = question_index + 1
                 else:
                     # All questions answered, move to next step
-                    if "next_step" in step_data:
-                        self.conversation_states[user_id]["current_step"] = step_data["next_step"]
-                    del self.conversation_states[user_id]["question_index"]
+                    if step.next_step_str is not None:
+                        state["current_step"] = step.next_step_str
+                    del state["question_index"]
     
     def _get_next_step(self, user_id: str, current_step: str, user_input: Optional[str] = None) -> str:
         """Determine the next step in the conversation flow"""
-        step_data = self.flow.get(current_step, {})
+        step = self._steps.get(current_step, _EMPTY_STEP)
         
         # If step has options and user provided input, use it to determine next step
-        if user_input and "options" in step_data and "next_step" in step_data and isinstance(step_data["next_step"], dict):
-            return step_data["next_step"].get(user_input, current_step)
+        if user_input and step.has_options and step.next_step_map is not None:
+            return step.next_step_map.get(user_input, current_step)
         
         # If step has a direct next step
-        if "next_step" in step_data and isinstance(step_data["next_step"], str):
-            return step_data["next_step"]
+        if step.next_step_str is not None:
+            return step.next_step_str
         
         # Default to current step if no next step is defined
         return current_step
     
-    def save_flow_to_file(self, flow_name: str, flow_data: Dict[str, Any]) -> str:
+    def save_flow_to_file(self, flow_name: str, flow_data: Dict[str, Any]) -> Path:
         """
         Save a conversation flow to a JSON file
         
@@ -269,9 +333,10 @@ class ConversationService:
             Path to the saved file
         """
         file_path = self.flows_dir / f"{flow_name}.json"
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(flow_data, f, ensure_ascii=False, indent=2)
-        return str(file_path)
+        # orjson writes UTF-8 bytes directly (no ASCII escaping), same layout as indent=2
+        file_path.write_bytes(orjson.dumps(flow_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        _flow_list_cache.pop(str(self.flows_dir), None)
+        return file_path
     
     def load_flow_from_file(self, flow_name: str) -> Dict[str, Any]:
         """
@@ -284,17 +349,26 @@ class ConversationService:
             Loaded flow data
         """
         file_path = self.flows_dir / f"{flow_name}.json"
-        if not file_path.exists():
-            raise FileNotFoundError(f"Flow file not found: {file_path}")
+        try:
+            # Keyed on mtime so edited flows are re-read
+            mtime_ns = file_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Flow file not found: {file_path}") from None
         
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return _load_flow_cached(str(file_path), mtime_ns)
     
-    def list_available_flows(self) -> list:
+    def list_available_flows(self) -> List[str]:
         """
         List all available conversation flows
         
         Returns:
             List of available flow names
         """
-        return [f.stem for f in self.flows_dir.glob("*.json")]
+        key = str(self.flows_dir)
+        now = time.monotonic()
+        cached = _flow_list_cache.get(key)
+        if cached and cached[0] > now:
+            return list(cached[1])
+        flows = [f.stem for f in self.flows_dir.glob("*.json")]
+        _flow_list_cache[key] = (now + FLOW_LIST_TTL, flows)
+        return list(flows)
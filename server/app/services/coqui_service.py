@@ -1,32 +1,74 @@
 """
 Service for integration with Coqui TTS (Local).
 """
+import hashlib
 import logging
 import os
-import uuid
-from typing import Optional
+import threading
+import time
+from contextlib import nullcontext
+from typing import Dict, Optional
 from fastapi import HTTPException
 
 from app.core.settings import get_settings
 
 logger = logging.getLogger(__name__)
 
+AUDIO_DIR = "storage/media/tts"
+
+# One lock per content hash so concurrent identical requests run a single inference
+_synthesis_locks: Dict[str, threading.Lock] = {}
+_synthesis_locks_guard = threading.Lock()
+
+
+def _synthesis_lock(key: str) -> threading.Lock:
+    with _synthesis_locks_guard:
+        lock = _synthesis_locks.get(key)
+        if lock is None:
+            lock = _synthesis_locks[key] = threading.Lock()
+        return lock
+
+
+def cleanup_cached_audio(max_age_hours: int = 24, audio_dir: str = AUDIO_DIR):
+    """Remove cached Coqui audio files not used within max_age_hours.
+    
+    Module-level so the scheduler can run it without loading the model.
+    """
+    cutoff = time.time() - max_age_hours * 3600
+    try:
+        with os.scandir(audio_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith("coqui_") and entry.name.endswith(".wav"):
+                    stat = entry.stat()
+                    if stat.st_atime < cutoff and stat.st_mtime < cutoff:
+                        try:
+                            os.remove(entry.path)
+                        except FileNotFoundError:
+                            continue
+                        logger.info(f"Removed cached TTS file: {entry.name}")
+    except Exception as e:
+        logger.error(f"Error cleaning up Coqui TTS files: {e}")
+
+
 class CoquiTTSService:
     def __init__(self):
         self.settings = get_settings()
         self.enabled = True
         self.tts = None
         self.device = "cpu"
+        # FP16 autocast on GPUs with tensor cores (compute capability >= 7.0)
+        self.use_fp16 = False
         self.model_name = "tts_models/multilingual/multi-dataset/xtts_v2"
         
         try:
             import torch
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            self.use_fp16 = self.device == "cuda" and torch.cuda.get_device_capability() >= (7, 0)
         except ImportError:
             logger.warning("torch not found. Coqui TTS will be disabled.")
             self.enabled = False
             
-        self.audio_dir = "storage/media/tts"
+        self.audio_dir = AUDIO_DIR
         os.makedirs(self.audio_dir, exist_ok=True)
         
         if self.enabled:
@@ -38,7 +80,7 @@ class CoquiTTSService:
             from TTS.api import TTS
             logger.info(f"Loading Coqui TTS model: {self.model_name} on {self.device}...")
             self.tts = TTS(self.model_name).to(self.device)
-            logger.info("Coqui TTS model loaded successfully.")
+            logger.info(f"Coqui TTS model loaded successfully (fp16={self.use_fp16}).")
         except ImportError:
             logger.error("Coqui TTS library not found. Please install 'TTS'.")
             self.enabled = False
@@ -46,6 +88,13 @@ class CoquiTTSService:
             logger.error(f"Failed to initialize Coqui TTS: {e}")
             self.enabled = False
 
+    def _inference_context(self):
+        """Autocast to FP16 on capable GPUs; plain FP32 otherwise."""
+        if not self.use_fp16:
+            return nullcontext()
+        import torch
+        return torch.autocast("cuda", dtype=torch.float16)
+
     def generate_speech(self, text: str, speaker: str = None, language: str = "es") -> Optional[str]:
         """
         Generate audio from text using Coqui TTS.
@@ -60,44 +109,53 @@ class CoquiTTSService:
             raise HTTPException(status_code=400, detail="Empty text for TTS")
             
         try:
-            # Generate unique filename
-            filename = f"coqui_{uuid.uuid4().hex[:10]}.wav"
-            filepath = os.path.join(self.audio_dir, filename)
-            
-            logger.info(f"Generating Coqui TTS audio for: {text[:50]}...")
-            
-            # XTTS requires a speaker wav for cloning or a speaker name if multi-speaker
-            # For XTTS v2, we usually provide a reference audio or speaker name.
-            # If using the base model without fine-tuning, we might need a reference.
-            # For simplicity/robustness, we'll try standard generation.
-            # Note: XTTS API often needs `speaker_wav` or `speaker_idx`.
-            
-            # If speaker is not provided, use a default reference if available, or let TTS handle it.
-            # For this implementation, we'll assume the model handles the default or we pass what we have.
-            
             # Check if model is XTTS to handle specific args
             is_xtts = "xtts" in self.model_name
             
-            generate_kwargs = {
-                "text": text,
-                "file_path": filepath,
-                "language": language if is_xtts else None # VITS might not need language arg if single-lang
-            }
+            # XTTS needs a speaker reference. Since we don't have a reference file handy in
+            # this generic code, we use the first speaker the model ships with.
+            speaker_name = self.tts.speakers[0] if is_xtts and self.tts.speakers else None
             
-            if is_xtts:
-                 # XTTS needs a speaker reference. We can use a default one included in the package or one we have.
-                 # For now, we'll try to use the first available speaker or a specific one if we had it.
-                 # Since we don't have a reference file handy in this generic code, 
-                 # we might rely on the API's default or fail if it demands one.
-                 # Let's try to list speakers and pick one? 
-                 # self.tts.speakers returns a list.
-                 if self.tts.speakers:
-                     generate_kwargs["speaker"] = self.tts.speakers[0] # Pick first speaker
+            # Same text, speaker and language always render the same audio, so the file
+            # name is a hash of them and repeated requests reuse the file on disk
+            key = hashlib.blake2b(
+                f"{text}|{speaker_name}|{language}".encode(), digest_size=16
+            ).hexdigest()
+            filename = f"coqui_{key}.wav"
+            filepath = os.path.join(self.audio_dir, filename)
+            public_url = f"http://localhost:8000/static/tts/{filename}"
             
-            self.tts.tts_to_file(**generate_kwargs)
+            try:
+                with _synthesis_lock(key):
+                    if os.path.exists(filepath):
+                        # Mark the file as used so the cleanup sweep keeps it
+                        os.utime(filepath)
+                        logger.info(f"Reusing cached Coqui TTS audio: {public_url}")
+                        return public_url
+                    
+                    logger.info(f"Generating Coqui TTS audio for: {text[:50]}...")
+                    
+                    # Write to a temporary name so a half-written file is never served
+                    tmp_path = os.path.join(self.audio_dir, f"tmp_{key}_{threading.get_ident()}.wav")
+                    generate_kwargs = {
+                        "text": text,
+                        "file_path": tmp_path,
+                        "language": language if is_xtts else None # VITS might not need language arg if single-lang
+                    }
+                    if speaker_name:
+                        generate_kwargs["speaker"] = speaker_name
+                    
+                    try:
+                        with self._inference_context():
+                            self.tts.tts_to_file(**generate_kwargs)
+                        os.replace(tmp_path, filepath)
+                    finally:
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+            finally:
+                with _synthesis_locks_guard:
+                    _synthesis_locks.pop(key, None)
             
-            # Return public URL
-            public_url = f"http://localhost:8000/static/tts/{filename}"
             logger.info(f"Audio generated: {public_url}")
             return public_url
             
@@ -107,3 +165,7 @@ class CoquiTTSService:
                 status_code=500,
                 detail=f"TTS generation failed: {str(e)}"
             )
+
+    def cleanup_old_files(self, max_age_hours: int = 24):
+        """Remove cached Coqui audio files not used within max_age_hours."""
+        cleanup_cached_audio(max_age_hours, self.audio_dir)
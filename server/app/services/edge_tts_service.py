@@ -4,13 +4,21 @@ Provides high-quality neural voices for free.
 """
 import logging
 import os
+import time
 import uuid
 import asyncio
 import nest_asyncio
-from typing import Optional, List
+from typing import Optional, List, Dict, AsyncIterator
 from fastapi import HTTPException
 import edge_tts
 
+try:
+    import aiofiles
+    AIOFILES_AVAILABLE = True
+except ImportError:
+    AIOFILES_AVAILABLE = False
+    aiofiles = None
+
 from app.core.settings import get_settings
 
 # Apply nest_asyncio to allow nested event loops (required for running edge-tts in FastAPI)
@@ -18,6 +26,9 @@ nest_asyncio.apply()
 
 logger = logging.getLogger(__name__)
 
+# The Edge voice catalog rarely changes; it is refetched after this many seconds
+VOICES_TTL = 24 * 3600
+
 class EdgeTTSService:
     def __init__(self):
         self.settings = get_settings()
@@ -25,6 +36,10 @@ class EdgeTTSService:
         self.default_voice = "es-MX-DaliaNeural" 
         self.audio_dir = "storage/media/tts"
         os.makedirs(self.audio_dir, exist_ok=True)
+        # Voice catalog and its index by language prefix ("es", "en", ...)
+        self._voices: List[dict] = []
+        self._voices_by_lang: Dict[str, List[dict]] = {}
+        self._voices_expires_at = 0.0
 
     async def generate_speech(self, text: str, voice: str = None) -> Optional[str]:
         """
@@ -52,8 +67,14 @@ class EdgeTTSService:
             # Create communicate object
             communicate = edge_tts.Communicate(text, voice)
             
-            # Save to file
-            await communicate.save(filepath)
+            # Write audio chunks to disk as they arrive instead of buffering the whole MP3
+            if AIOFILES_AVAILABLE:
+                async with aiofiles.open(filepath, "wb") as f:
+                    async for chunk in communicate.stream():
+                        if chunk["type"] == "audio":
+                            await f.write(chunk["data"])
+            else:
+                await communicate.save(filepath)
             
             # Return public URL
             # Assuming static files are served from /static/tts
@@ -68,14 +89,44 @@ class EdgeTTSService:
                 detail=f"TTS generation failed: {str(e)}"
             )
 
+    async def generate_speech_stream(self, text: str, voice: str = None) -> AsyncIterator[bytes]:
+        """
+        Yield MP3 chunks as Edge-TTS synthesizes them.
+        
+        Meant to be wrapped in a StreamingResponse(media_type="audio/mpeg") so the
+        client starts receiving audio before synthesis finishes.
+        """
+        if not text.strip():
+            raise HTTPException(status_code=400, detail="Empty text for TTS")
+        
+        communicate = edge_tts.Communicate(text, voice or self.default_voice)
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                yield chunk["data"]
+
+    async def refresh_voices(self) -> List[dict]:
+        """Fetch the voice catalog from Edge and rebuild the language index."""
+        voices = await edge_tts.list_voices()
+        voices_by_lang: Dict[str, List[dict]] = {}
+        for voice in voices:
+            voices_by_lang.setdefault(voice["ShortName"].split("-")[0], []).append(voice)
+        self._voices = voices
+        self._voices_by_lang = voices_by_lang
+        self._voices_expires_at = time.monotonic() + VOICES_TTL
+        return voices
+
     async def get_available_voices(self, language: str = "es") -> List[dict]:
         """Get available voices, optionally filtered by language."""
         try:
-            voices = await edge_tts.list_voices()
+            if time.monotonic() >= self._voices_expires_at:
+                await self.refresh_voices()
             
             if language:
-                return [v for v in voices if v["ShortName"].startswith(language)]
-            return voices
+                if language in self._voices_by_lang:
+                    return list(self._voices_by_lang[language])
+                # Locale-style filters such as "es-MX"
+                return [v for v in self._voices if v["ShortName"].startswith(language)]
+            return list(self._voices)
             
         except Exception as e:
             logger.error(f"Error listing voices: {e}")
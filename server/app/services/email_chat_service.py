@@ -1,21 +1,82 @@
 """Email chat service orchestrating inbound/outbound email handling."""
 from __future__ import annotations
 
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 from datetime import datetime
+from email.utils import parseaddr
+import asyncio
+import re
+import threading
+import time
+
+import orjson
 
 from sqlalchemy.orm import Session
 
-from ..core.database import get_db
+from ..core.database import DbSession
 from ..core.logging import get_logger
 from ..models.chat import MessageDirection, MessageType
 from ..repositories.user_repository import UserRepository
 from ..repositories.chat_repository import ChatRepository, MessageRepository
 from .ollama_service import OllamaService
 from .email_service import EmailService
+from .chat_service import invalidate_active_sessions
 
 logger = get_logger(__name__)
 
+# Email address -> user id, reused for this many seconds: {email: (expires_at, user_id)}
+EMAIL_USER_CACHE_TTL = 60
+EMAIL_USER_CACHE_MAX = 10_000
+_email_user_ids: Dict[str, Tuple[float, int]] = {}
+_email_user_ids_lock = threading.Lock()
+
+
+def _cached_user_id(email: str) -> Optional[int]:
+    """User id recently resolved for an email address, if still fresh."""
+    with _email_user_ids_lock:
+        cached = _email_user_ids.get(email)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+    return None
+
+
+def _cache_user_id(email: str, user_id: int) -> None:
+    with _email_user_ids_lock:
+        if len(_email_user_ids) >= EMAIL_USER_CACHE_MAX:
+            # Drop the oldest insertion to stay bounded
+            _email_user_ids.pop(next(iter(_email_user_ids)))
+        _email_user_ids[email] = (time.monotonic() + EMAIL_USER_CACHE_TTL, user_id)
+
+
+# Subjects of bounces and out-of-office replies, which get stored but never answered
+_AUTO_RE = re.compile(
+    r"^(?:auto-reply|automatic reply|out of office|delivery status|undeliverable|mailer-daemon)",
+    re.I,
+)
+
+
+def _header_value(headers: Any, name: str) -> Optional[str]:
+    """Look up a header in either a {name: value} dict or a [{name, value}] list."""
+    if isinstance(headers, dict):
+        for key, value in headers.items():
+            if key.lower() == name:
+                return value
+    elif isinstance(headers, list):
+        for header in headers:
+            if isinstance(header, dict) and str(header.get("name", "")).lower() == name:
+                return header.get("value")
+    return None
+
+
+def _is_auto_reply(inbound: Dict[str, Any]) -> bool:
+    """True for bounces, auto-replies and empty bodies, which need no AI reply."""
+    auto_submitted = (inbound.get("auto_submitted") or "").strip().lower()
+    if auto_submitted and auto_submitted != "no":
+        return True
+    if not inbound["content"].strip():
+        return True
+    return bool(_AUTO_RE.match(inbound["subject"].strip()))
+
 
 class EmailChatService:
     """Service to process email conversations."""
@@ -26,27 +87,33 @@ class EmailChatService:
 
     def persist_outgoing_email(self, request, provider_response: Dict[str, Any]) -> Dict[str, Any]:
         """Persist outgoing email message in the database."""
-        with get_db() as db:
+        with DbSession() as db:
             user_repo = UserRepository(db)
             chat_repo = ChatRepository(db)
             message_repo = MessageRepository(db)
 
-            user = user_repo.get_by_email(request.to)
-            if not user:
-                user = user_repo.create_email_user(email=request.to, name=None)
+            # Only the id is needed here, so a cached one skips the user query
+            user_id = _cached_user_id(request.to)
+            if user_id is None:
+                user = user_repo.get_by_email(request.to)
+                if not user:
+                    user = user_repo.create_email_user(email=request.to, name=None)
+                user_id = user.id
+                _cache_user_id(request.to, user_id)
 
-            session = chat_repo.get_active_session_for_user(user.id, channel="email")
+            session = chat_repo.get_active_session_for_user(user_id, channel="email")
             if not session:
-                session_id = f"email_{user.id}_{int(datetime.utcnow().timestamp())}"
+                session_id = f"email_{user_id}_{time.time_ns()}"
                 session = chat_repo.create_session(
-                    user_id=user.id,
+                    user_id=user_id,
                     session_id=session_id,
                     channel="email",
                     ai_personality="ana",
                 )
+                invalidate_active_sessions()
 
             message = message_repo.create_message(
-                user_id=user.id,
+                user_id=user_id,
                 chat_session_id=session.id,
                 content=request.text or request.html or "",
                 subject=request.subject,
@@ -54,77 +121,117 @@ class EmailChatService:
                 message_type=MessageType.TEXT.value,
                 channel="email",
                 external_id=provider_response.get("id"),
-                raw_content=str(provider_response),
+                raw_content=orjson.dumps(provider_response, default=str).decode(),
             )
 
             return {
                 "message_id": message.id,
                 "session_id": session.id,
-                "user_id": user.id,
+                "user_id": user_id,
                 "external_id": message.external_id,
                 "channel": message.channel,
             }
 
-    def process_incoming_email(self, payload: Dict[str, Any]) -> None:
+    async def process_incoming_email(self, payload: Dict[str, Any]) -> None:
         """Process incoming email payload asynchronously."""
         try:
-            with get_db() as db:
-                user_repo = UserRepository(db)
-                chat_repo = ChatRepository(db)
-                message_repo = MessageRepository(db)
+            # DB work and the Ollama call block, so they run in a worker thread;
+            # the reply is then sent on the running event loop
+            prepared = await asyncio.to_thread(self._record_incoming_email, payload)
+            if prepared is None:
+                return
 
-                inbound = self._parse_incoming_payload(payload)
-                if inbound is None:
-                    logger.warning("Email payload missing required fields: %s", payload)
-                    return
+            inbound, reply_text, user_id, session_id = prepared
+            await self._send_ai_email_reply(inbound, reply_text, user_id, session_id)
 
-                user = user_repo.get_by_email(inbound["from_email"])
-                if not user:
-                    user = user_repo.create_email_user(email=inbound["from_email"], name=inbound["from_name"])
-                else:
-                    user_repo.update_last_channel(user.id, "email")
-
-                session = chat_repo.get_active_session_for_user(user.id, channel="email")
-                if not session:
-                    session_id = f"email_{user.id}_{int(datetime.utcnow().timestamp())}"
-                    session = chat_repo.create_session(
-                        user_id=user.id,
-                        session_id=session_id,
-                        channel="email",
-                        ai_personality="ana",
-                    )
-
-                existing = None
-                if inbound["external_id"]:
-                    existing = message_repo.get_by_external_id(inbound["external_id"])
-                if existing:
-                    logger.info("Duplicate email message %s ignored", inbound["external_id"])
-                    return
-
-                incoming_message = message_repo.create_message(
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Error processing incoming email: %s", exc)
+
+    def _record_incoming_email(
+        self, payload: Dict[str, Any]
+    ) -> Optional[Tuple[Dict[str, Any], str, int, int]]:
+        """Store the inbound email and generate the AI reply (blocking).
+
+        Returns:
+            (inbound, reply_text, user_id, session_id), or None if there is nothing to send
+        """
+        with DbSession() as db:
+            user_repo = UserRepository(db)
+            chat_repo = ChatRepository(db)
+            message_repo = MessageRepository(db)
+
+            inbound = self._parse_incoming_payload(payload)
+            if inbound is None:
+                logger.warning("Email payload missing required fields: %s", payload)
+                return None
+
+            # Duplicate check, user and active email session in two queries
+            user, session, duplicate = chat_repo.bootstrap_email_conversation(
+                inbound["from_email"], inbound["external_id"]
+            )
+            if duplicate:
+                logger.info("Duplicate email message %s ignored", inbound["external_id"])
+                return None
+
+            if not user:
+                user = user_repo.create_email_user(email=inbound["from_email"], name=inbound["from_name"])
+            else:
+                # Committed together with the message below
+                user.last_channel = "email"
+                user.last_activity_date = datetime.utcnow()
+            _cache_user_id(inbound["from_email"], user.id)
+
+            incoming_message = message_repo.build_message(
+                user_id=user.id,
+                chat_session_id=session.id if session else None,
+                content=inbound["content"],
+                subject=inbound["subject"],
+                direction=MessageDirection.INCOMING,
+                message_type=MessageType.TEXT.value,
+                channel="email",
+                external_id=inbound["external_id"],
+                raw_content=orjson.dumps(payload, default=str).decode(),
+            )
+            new_session = session is None
+            if new_session:
+                # A new session is inserted in the same flush, ahead of the message
+                session = chat_repo.build_session(
                     user_id=user.id,
-                    chat_session_id=session.id,
-                    content=inbound["content"],
-                    subject=inbound["subject"],
-                    direction=MessageDirection.INCOMING,
-                    message_type=MessageType.TEXT.value,
+                    session_id=f"email_{user.id}_{time.time_ns()}",
                     channel="email",
-                    external_id=inbound["external_id"],
-                    raw_content=str(payload),
+                    ai_personality="ana",
                 )
+                incoming_message.chat_session = session
 
-                reply_text = self._generate_ai_response(
-                    db,
-                    user_id=user.id,
-                    session_id=session.id,
-                    content=inbound["content"],
-                )
+            # Read before the commit expires the user, so the prompt needs no refresh SELECT
+            user_context = {
+                "name": user.name,
+                "email": user.email,
+                "language": user.language,
+                "total_messages": user.total_messages,
+            }
+            user_id = user.id
 
-                if reply_text:
-                    self._send_ai_email_reply(inbound, reply_text, user, session, message_repo)
+            # One commit for the new session, the message and the user's channel update
+            db.add(incoming_message)
+            db.commit()
+            if new_session:
+                invalidate_active_sessions()
 
-        except Exception as exc:  # pylint: disable=broad-except
-            logger.exception("Error processing incoming email: %s", exc)
+            if _is_auto_reply(inbound):
+                logger.info("Email %s is an auto-reply or bounce, no AI reply", inbound["external_id"])
+                return None
+
+            reply_text = self._generate_ai_response(
+                db,
+                user_context=user_context,
+                session_id=session.id,
+                content=inbound["content"],
+            )
+            if not reply_text:
+                return None
+
+            return inbound, reply_text, user_id, session.id
 
     def _parse_incoming_payload(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Extract required fields from Resend webhook payload."""
@@ -139,44 +246,26 @@ class EmailChatService:
         if not (from_header and subject and message_id):
             return None
 
-        name, address = self._split_from_header(from_header)
+        # RFC 2822 parsing handles quoted names and addresses without a display name
+        name, address = parseaddr(from_header)
+        address = address or from_header
 
         return {
             "from_name": name,
             "from_email": address,
             "subject": subject,
-            "content": text or email.get("html", ""),
+            "content": text or email.get("html") or "",
             "external_id": message_id,
+            "auto_submitted": _header_value(email.get("headers") or {}, "auto-submitted"),
         }
 
-    @staticmethod
-    def _split_from_header(header: str) -> tuple[str, str]:
-        if "<" in header and ">" in header:
-            name_part, email_part = header.split("<", 1)
-            return name_part.strip().strip('"'), email_part.strip().rstrip(">")
-        return "", header
-
     def _generate_ai_response(
-        self, db: Session, user_id: int, session_id: int, content: str
+        self, db: Session, user_context: Dict[str, Any], session_id: int, content: str
     ) -> Optional[str]:
         try:
             message_repo = MessageRepository(db)
-            user_repo = UserRepository(db)
-            chat_repo = ChatRepository(db)
-
-            user = user_repo.get(user_id)
-            session = chat_repo.get(session_id)
-            if not user or not session:
-                return None
 
             context = message_repo.get_conversation_context(session_id, max_messages=10)
-            user_context = {
-                "name": user.name,
-                "email": user.email,
-                "language": user.language,
-                "total_messages": user.total_messages,
-            }
-
             return self.ollama_service.generate_response(
                 user_message=content,
                 conversation_history=context,
@@ -186,40 +275,43 @@ class EmailChatService:
             logger.exception("Failed to generate AI response: %s", exc)
             return None
 
-    def _send_ai_email_reply(
+    async def _send_ai_email_reply(
         self,
         inbound: Dict[str, Any],
         ai_text: str,
-        user,
-        session,
-        message_repo: MessageRepository,
+        user_id: int,
+        session_id: int,
     ) -> None:
         try:
-            metadata = {"in_reply_to": inbound["external_id"]}
-            reply = awaitable(self.email_service.send_email)(
+            subject = f"Re: {inbound['subject']}"
+            reply = await self.email_service.send_email(
                 to=inbound["from_email"],
-                subject=f"Re: {inbound['subject']}",
+                subject=subject,
                 text=ai_text,
-                metadata=metadata,
+                metadata={"in_reply_to": inbound["external_id"]},
             )
 
-            message_repo.create_message(
-                user_id=user.id,
-                chat_session_id=session.id,
+            await asyncio.to_thread(self._persist_ai_email_reply, user_id, session_id, subject, ai_text, reply)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Failed to send AI email reply: %s", exc)
+
+    def _persist_ai_email_reply(
+        self,
+        user_id: int,
+        session_id: int,
+        subject: str,
+        ai_text: str,
+        reply: Dict[str, Any],
+    ) -> None:
+        with DbSession() as db:
+            MessageRepository(db).create_message(
+                user_id=user_id,
+                chat_session_id=session_id,
                 content=ai_text,
-                subject=f"Re: {inbound['subject']}",
+                subject=subject,
                 direction=MessageDirection.OUTGOING,
                 message_type=MessageType.TEXT.value,
                 channel="email",
                 external_id=reply.get("id"),
-                raw_content=str(reply),
+                raw_content=orjson.dumps(reply, default=str).decode(),
             )
-        except Exception as exc:  # pylint: disable=broad-except
-            logger.exception("Failed to send AI email reply: %s", exc)
-
-
-def awaitable(coro):
-    """Helper to run coroutine in sync context."""
-    import asyncio
-
-    return asyncio.run(coro)
@@ -1,48 +1,89 @@
 """
 Servicio para integración con KaniTTS (Text-to-Speech)
 """
+import asyncio
 import logging
-import requests
+import httpx
 import os
+import time
 import uuid
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from urllib.parse import urljoin
 from fastapi import HTTPException
 
+try:
+    import aiofiles
+    AIOFILES_AVAILABLE = True
+except ImportError:
+    AIOFILES_AVAILABLE = False
+    aiofiles = None
+
 from app.core.settings import get_settings
 
 logger = logging.getLogger(__name__)
 
+# Segundos durante los que se reutiliza el resultado del health check
+HEALTH_CHECK_TTL = 5.0
+
+# Tamaño de bloque al volcar el audio recibido a disco
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Segundos durante los que se reutilizan los catálogos de voces e idiomas
+CATALOG_TTL = 300.0
+
 class KaniTTSService:
-    def __init__(self):
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
         self.settings = get_settings()
         self.base_url = getattr(self.settings, 'KANITTS_BASE_URL', 'http://127.0.0.1:8020')
         self.default_speaker = getattr(self.settings, 'KANITTS_DEFAULT_SPEAKER', 'es-mx-female-1')
         self.default_language = getattr(self.settings, 'KANITTS_DEFAULT_LANGUAGE', 'es')
         # Force timeout to 300s to avoid env var overrides causing 502s
         self.timeout = 300 # getattr(self.settings, 'KANITTS_TIMEOUT', 300)
+        # Los llamadores consultan este flag para evitar la llamada cuando está apagado
         self.enabled = getattr(self.settings, 'KANITTS_ENABLED', True)
         
+        # Cliente HTTP con conexiones keep-alive; puede compartirse desde CallService
+        self._owns_http_client = http_client is None
+        self.http_client = http_client or httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout, connect=5.0),
+            transport=httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                retries=2
+            )
+        )
+        
         # Directorio para almacenar archivos de audio
         self.audio_dir = "storage/media/tts"
         os.makedirs(self.audio_dir, exist_ok=True)
+        
+        # (instante de la última comprobación, resultado)
+        self._health_cache = (0.0, False)
+        # {endpoint: (caduca_en, elementos)} para /speakers y /languages
+        self._catalog_cache: Dict[str, Tuple[float, list]] = {}
 
-    def is_available(self) -> bool:
+    async def is_available(self) -> bool:
         """Verificar si KaniTTS está disponible"""
         if not self.enabled:
             return False
+        
+        checked_at, available = self._health_cache
+        if time.monotonic() - checked_at < HEALTH_CHECK_TTL:
+            return available
             
         try:
-            response = requests.get(
+            response = await self.http_client.get(
                 f"{self.base_url}/health",
                 timeout=5
             )
-            return response.status_code == 200
+            available = response.status_code == 200
         except Exception as e:
             logger.warning(f"KaniTTS no disponible: {e}")
-            return False
+            available = False
+        
+        self._health_cache = (time.monotonic(), available)
+        return available
 
-    def generate_speech(self, text: str, speaker: str = None, language: str = None) -> Optional[str]:
+    async def generate_speech(self, text: str, speaker: str = None, language: str = None) -> Optional[str]:
         """
         Generar audio a partir de texto usando KaniTTS
         
@@ -87,36 +128,37 @@ class KaniTTSService:
             routes = ["/tts"]
             response = None
             last_error = None
+            public_url = None
             for route in routes:
                 try:
                     logger.info(f"Intentando TTS en: {self.base_url}{route}")
-                    response = requests.post(
+                    async with self.http_client.stream(
+                        "POST",
                         f"{self.base_url}{route}",
                         json=payload,
                         timeout=self.timeout
-                    )
-                    if response.status_code == 200:
-                        break
-                    else:
-                        last_error = (response.status_code, response.text)
-                        logger.warning(f"Fallo ruta {route}: {response.status_code} - {response.text}")
-                        continue
-                except requests.exceptions.RequestException as e:
+                    ) as response:
+                        if response.status_code == 200:
+                            # Generar nombre único para el archivo
+                            filename = f"call_tts_{uuid.uuid4().hex[:10]}.wav"
+                            filepath = os.path.join(self.audio_dir, filename)
+                            
+                            # Volcar el audio a disco por bloques, sin cargar el WAV entero en memoria
+                            await self._save_stream(response, filepath)
+                            public_url = f"http://localhost:8000/static/tts/{filename}"
+                            break
+                        else:
+                            await response.aread()
+                            last_error = (response.status_code, response.text)
+                            logger.warning(f"Fallo ruta {route}: {response.status_code} - {response.text}")
+                            continue
+                except httpx.TransportError as e:
                     last_error = ("request_exception", str(e))
                     logger.warning(f"Excepción en ruta {route}: {e}")
                     continue
             
-            if response and response.status_code == 200:
-                # Generar nombre único para el archivo
-                filename = f"call_tts_{uuid.uuid4().hex[:10]}.wav"
-                filepath = os.path.join(self.audio_dir, filename)
-                
-                # Guardar archivo de audio
-                with open(filepath, 'wb') as f:
-                    f.write(response.content)
-                
+            if public_url:
                 # Retornar URL pública del archivo
-                public_url = f"http://localhost:8000/static/tts/{filename}"
                 logger.info(f"Audio generado: {public_url}")
                 return public_url
                 
@@ -134,13 +176,13 @@ class KaniTTSService:
                     detail=f"Error del servidor TTS: {code} - {text}"
                 )
                 
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error("Timeout en solicitud a KaniTTS")
             raise HTTPException(
                 status_code=504,
                 detail="Timeout en servicio TTS"
             )
-        except requests.exceptions.ConnectionError:
+        except httpx.ConnectError:
             logger.error("Error de conexión con KaniTTS")
             raise HTTPException(
                 status_code=502,
@@ -156,63 +198,88 @@ class KaniTTSService:
                 detail=f"Error interno del servicio TTS: {str(e)}"
             )
 
-    def get_available_speakers(self) -> list:
-        """Obtener lista de voces disponibles"""
+    async def _get_catalog(self, endpoint: str, key: str, label: str) -> list:
+        """Obtener un catálogo casi estático del servidor, cacheado CATALOG_TTL segundos"""
         if not self.enabled:
             return []
+        
+        cached = self._catalog_cache.get(endpoint)
+        if cached and cached[0] > time.monotonic():
+            return list(cached[1])
             
         try:
-            response = requests.get(
-                f"{self.base_url}/speakers",
+            response = await self.http_client.get(
+                f"{self.base_url}{endpoint}",
                 timeout=10
             )
             
             if response.status_code == 200:
-                return response.json().get('speakers', [])
+                items = response.json().get(key, [])
+                self._catalog_cache[endpoint] = (time.monotonic() + CATALOG_TTL, items)
+                return list(items)
             else:
-                logger.error(f"Error obteniendo voces: {response.status_code}")
+                logger.error(f"Error obteniendo {label}: {response.status_code}")
                 return []
                 
         except Exception as e:
-            logger.error(f"Error obteniendo voces disponibles: {e}")
+            logger.error(f"Error obteniendo {label}: {e}")
             return []
 
-    def get_supported_languages(self) -> list:
+    async def get_available_speakers(self) -> list:
+        """Obtener lista de voces disponibles"""
+        return await self._get_catalog("/speakers", "speakers", "voces")
+
+    async def get_supported_languages(self) -> list:
         """Obtener lista de idiomas soportados"""
-        if not self.enabled:
-            return []
-            
-        try:
-            response = requests.get(
-                f"{self.base_url}/languages",
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                return response.json().get('languages', [])
-            else:
-                logger.error(f"Error obteniendo idiomas: {response.status_code}")
-                return []
-                
-        except Exception as e:
-            logger.error(f"Error obteniendo idiomas soportados: {e}")
-            return []
+        return await self._get_catalog("/languages", "languages", "idiomas")
 
     def cleanup_old_files(self, max_age_hours: int = 24):
         """Limpiar archivos de audio antiguos"""
         try:
-            import time
             current_time = time.time()
             max_age_seconds = max_age_hours * 3600
             
-            for filename in os.listdir(self.audio_dir):
-                if filename.endswith('.wav'):
-                    filepath = os.path.join(self.audio_dir, filename)
-                    file_age = current_time - os.path.getctime(filepath)
-                    
-                    if file_age > max_age_seconds:
-                        os.remove(filepath)
-                        logger.info(f"Archivo eliminado: {filename}")
+            # scandir devuelve el tipo de entrada sin stat extra; un stat por .wav.
+            # Los coqui_*.wav son la caché de Coqui, que los limpia según su último uso
+            with os.scandir(self.audio_dir) as entries:
+                for entry in entries:
+                    if entry.name.startswith('coqui_') or not entry.name.endswith('.wav') or not entry.is_file():
+                        continue
+                    if current_time - entry.stat().st_ctime > max_age_seconds:
+                        try:
+                            os.unlink(entry.path)
+                        except FileNotFoundError:
+                            continue
+                        logger.info(f"Archivo eliminado: {entry.name}")
                         
         except Exception as e:
-            logger.error(f"Error limpiando archivos antiguos: {e}")
\ No newline at end of file
+            logger.error(f"Error limpiando archivos antiguos: {e}")
+
+    @staticmethod
+    async def _save_stream(response: httpx.Response, filepath: str) -> None:
+        """Escribir el cuerpo de la respuesta en disco a medida que llega"""
+        try:
+            if AIOFILES_AVAILABLE:
+                async with aiofiles.open(filepath, 'wb') as f:
+                    async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                        await f.write(chunk)
+            else:
+                # Sin aiofiles, la escritura bloqueante se hace en un hilo, fuera del event loop
+                f = await asyncio.to_thread(open, filepath, 'wb')
+                try:
+                    async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                        await asyncio.to_thread(f.write, chunk)
+                finally:
+                    await asyncio.to_thread(f.close)
+        except BaseException:
+            # No dejar un WAV a medias si el stream falla o se cancela
+            try:
+                os.unlink(filepath)
+            except FileNotFoundError:
+                pass
+            raise
+
+    async def aclose(self):
+        """Cerrar el cliente HTTP si fue creado por este servicio"""
+        if self._owns_http_client:
+            await self.http_client.aclose()
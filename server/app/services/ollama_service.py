@@ -3,6 +3,7 @@ Ollama AI service for generating responses
 """
 
 import json
+import re
 from typing import Dict, Any, List, Optional
 from datetime import datetime
 import os
@@ -32,6 +33,9 @@ from ..core.exceptions import OllamaError, ServiceUnavailableError
 logger = get_logger(__name__)
 settings = get_settings()
 
+# Assistant turns mentioning these terms are dropped from the prompt
+_CONTAMINATION_RE = re.compile(r"seguro|insurance|vive tranqui|venzamos|peludito", re.IGNORECASE)
+
 
 class OllamaService:
     """Service for Ollama AI operations"""
@@ -210,7 +214,7 @@ class OllamaService:
                 elif msg["role"] == "assistant":
                     # Filter out assistant messages that mention seguros/insurance
                     content = msg.get("content", "")
-                    if not any(word in content.lower() for word in ["seguro", "insurance", "vive tranqui", "venzamos", "peludito"]):
+                    if not _CONTAMINATION_RE.search(content):
                         prompt_parts.append(f"Assistant: {content}")
                     else:
                         logger.warning(f"Filtered out contaminated assistant message: {content[:50]}...")
@@ -0,0 +1,127 @@
+"""
+Semantic cache for AI replies
+
+Stores normalized Ollama embeddings of user messages per namespace (for example
+model and conversation step) and returns a previous reply when a new message is
+close enough (cosine >= threshold).
+"""
+
+import threading
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+# Import ollama library
+try:
+    import ollama
+    OLLAMA_AVAILABLE = True
+except ImportError:
+    OLLAMA_AVAILABLE = False
+    ollama = None
+
+from ..core.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class _Namespace:
+    """Fixed-size ring buffer of embeddings and replies for one namespace"""
+
+    __slots__ = ("keys", "slot_keys", "vectors", "responses", "cursor", "size")
+
+    def __init__(self, capacity: int, dim: int):
+        self.keys: Dict[str, int] = {}
+        self.slot_keys: List[Optional[str]] = [None] * capacity
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.responses: List[Optional[str]] = [None] * capacity
+        self.cursor = 0
+        self.size = 0
+
+
+class SemanticCache:
+    """In-process semantic cache of AI replies keyed by (namespace, message)"""
+
+    def __init__(
+        self,
+        embedding_model: str,
+        threshold: float = 0.92,
+        max_entries: int = 10_000
+    ):
+        self.embedding_model = embedding_model
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.enabled = OLLAMA_AVAILABLE
+        self._namespaces: Dict[Hashable, _Namespace] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(message: str) -> str:
+        """Collapse case and whitespace so trivial variants share an entry"""
+        return " ".join(message.lower().split())
+
+    def embed(self, text: str) -> Optional[np.ndarray]:
+        """Return the L2-normalized embedding for text, or None on failure"""
+        if not self.enabled or not text:
+            return None
+        try:
+            result = ollama.embeddings(model=self.embedding_model, prompt=text)
+            vector = np.asarray(result["embedding"], dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Semantic cache embedding failed: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
+
+    def lookup(self, namespace_key: Hashable, message: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """
+        Find a cached reply for message in the given namespace
+
+        Returns:
+            (cached reply or None, embedding to pass to store() on a miss)
+        """
+        normalized = self.normalize(message)
+        with self._lock:
+            namespace = self._namespaces.get(namespace_key)
+            if namespace is not None and normalized in namespace.keys:
+                return namespace.responses[namespace.keys[normalized]], None
+
+        embedding = self.embed(normalized)
+        if embedding is None:
+            return None, None
+
+        with self._lock:
+            namespace = self._namespaces.get(namespace_key)
+            if namespace is None or namespace.size == 0 or namespace.vectors.shape[1] != embedding.shape[0]:
+                return None, embedding
+            # Slots fill from 0 and are then overwritten in place, so the first `size` rows are live
+            scores = namespace.vectors[:namespace.size] @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                logger.info(f"Semantic cache hit ({scores[best]:.3f}) for {namespace_key}")
+                return namespace.responses[best], None
+        return None, embedding
+
+    def store(self, namespace_key: Hashable, message: str, embedding: Optional[np.ndarray], response: str) -> None:
+        """Cache response for message; the oldest slot in the namespace is overwritten when full"""
+        if embedding is None or not response:
+            return
+        normalized = self.normalize(message)
+        with self._lock:
+            namespace = self._namespaces.get(namespace_key)
+            if namespace is None:
+                namespace = _Namespace(self.max_entries, embedding.shape[0])
+                self._namespaces[namespace_key] = namespace
+            if normalized in namespace.keys or namespace.vectors.shape[1] != embedding.shape[0]:
+                return
+            slot = namespace.cursor
+            evicted = namespace.slot_keys[slot]
+            if evicted is not None:
+                del namespace.keys[evicted]
+            namespace.vectors[slot] = embedding
+            namespace.responses[slot] = response
+            namespace.slot_keys[slot] = normalized
+            namespace.keys[normalized] = slot
+            namespace.cursor = (slot + 1) % self.max_entries
+            namespace.size = min(namespace.size + 1, self.max_entries)
@@ -3,8 +3,10 @@ WhatsApp Business API service for sending and receiving messages
 """
 
 import json
+import time
+import threading
 import requests
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 from datetime import datetime
 
 from ..core.config import get_settings, get_whatsapp_api_url
@@ -14,6 +16,11 @@ from ..core.exceptions import WhatsAppAPIError, ValidationError
 logger = get_logger(__name__)
 settings = get_settings()
 
+# Graph API media URLs expire after ~5 minutes; resolved URLs are reused for
+# a bit less than that so retried webhooks skip the lookup
+MEDIA_URL_TTL = 240
+MEDIA_URL_CACHE_MAX = 1024
+
 
 class WhatsAppService:
     """Service for WhatsApp Business API operations"""
@@ -30,6 +37,10 @@ class WhatsAppService:
             "Content-Type": "application/json"
         }
         
+        # media_id -> (expires_at, url)
+        self._media_url_cache: Dict[str, Tuple[float, str]] = {}
+        self._media_url_lock = threading.Lock()
+        
         logger.info(f"WhatsApp service initialized with phone number ID: {self.phone_number_id}")
     
     def verify_webhook(self, mode: str, token: str, challenge: str) -> Optional[str]:
@@ -368,6 +379,12 @@ class WhatsAppService:
         Returns:
             Media URL or None if failed
         """
+        now = time.monotonic()
+        with self._media_url_lock:
+            cached = self._media_url_cache.get(media_id)
+        if cached and cached[0] > now:
+            return cached[1]
+        
         url = f"{self.base_url}/{media_id}"
         
         try:
@@ -378,6 +395,12 @@ class WhatsAppService:
             result = response.json()
             media_url = result.get("url")
             logger.info(f"Media URL retrieved: {media_url}")
+            if media_url:
+                with self._media_url_lock:
+                    self._media_url_cache[media_id] = (now + MEDIA_URL_TTL, media_url)
+                    if len(self._media_url_cache) > MEDIA_URL_CACHE_MAX:
+                        # Dicts keep insertion order, so this drops the oldest entry
+                        del self._media_url_cache[next(iter(self._media_url_cache))]
             return media_url
             
         except requests.exceptions.RequestException as e: